@@ -0,0 +1,17 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from base.utils import config
+
+SECTION = "hgchangefeed"
+
+def config_value(name, default = None):
+    # Reads an option from the hgchangefeed section of the site config,
+    # converted to the type of default, or returns default if it isn't set
+    if not config.has_option(SECTION, name):
+        return default
+    value = config.get(SECTION, name)
+    if default is None:
+        return value
+    return type(default)(value)
@@ -15,19 +15,11 @@ def path(request, repository_name, path_name):
     path = Path.get_by_path(path_name)
     repository = get_object_or_404(Repository, name = repository_name, paths = path, hidden = False)
 
-    queryparams = {
-        "pushes__push__repository": repository,
-    }
-
-    if path.parent is not None:
-        queryparams["changes__path__ancestors__ancestor"] = path
-
+    types = None
     if "types" in request.GET:
         types = [TYPEMAP[t] for t in request.GET["types"].split(",")]
-        queryparams["changes__type__in"] = types
 
-    changesets = Changeset.objects.filter(**queryparams).distinct().order_by("-pushes__push__push_id", "-pushes__index")
-    changesets = list(changesets[:20])
+    changesets = recent_changesets(repository, path, types, 20)
     if len(changesets):
         tag = "feed:%s/%s:%s:%s" % (repository_name, path_name, changesets[0].hex, changesets[-1].hex)
     else:
@@ -42,10 +34,11 @@ def render_path(request, repository, path, changesets):
         link = reverse('path', args=[repository, path])
     )
 
+    changes = changeset_changes(changesets)
     for changeset in changesets:
         feed.add_item(
             title = "Changeset %s" % changeset,
-            description = render_to_string("pathfeed.html", { "changeset": changeset }),
+            description = render_to_string("pathfeed.html", { "changeset": changeset, "changes": changes[changeset.id] }),
             link = "%srev/%s" % (repository.url, changeset),
             author_name = changeset.author.split(" <")[0],
             pubdate = changeset.localdate,
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from array import array
+from binascii import hexlify, unhexlify
+from collections import deque
+
+from website.models import *
+
+def chunks(values):
+    values = list(values)
+    for i in range(0, len(values), PATH_CHUNK):
+        yield values[i:i + PATH_CHUNK]
+
+def prefetch_graph(changesets):
+    # Fills in the parents and children of each changeset with a few queries
+    # for each PATH_CHUNK changesets so walking to them doesn't make one query
+    # for each. Parents that aren't indexed are None as they are without
+    # prefetching.
+    changesets = list(changesets)
+    byid = dict((c.id, c) for c in changesets)
+    byhex = dict((c.hex, c) for c in changesets)
+
+    # The edges of a changeset are always in the same chunk so stay in order
+    parents = []
+    for chunk in chunks(byid.keys()):
+        edges = ChangesetParent.objects.filter(changeset__in = chunk).order_by("id")
+        parents.extend(edges.values_list("changeset_id", "parenthex"))
+    children = []
+    for chunk in chunks(byhex.keys()):
+        edges = ChangesetParent.objects.filter(parenthex__in = chunk).order_by("id")
+        children.extend(edges.values_list("changeset_id", "parenthex"))
+
+    hexes = set(hex for (id, hex) in parents if hex not in byhex)
+    ids = set(id for (id, hex) in children if id not in byid)
+    found = []
+    for chunk in chunks(hexes):
+        found.extend(Changeset.objects.filter(hex__in = chunk))
+    for chunk in chunks(ids):
+        found.extend(Changeset.objects.filter(id__in = chunk))
+    for changeset in found:
+        byid.setdefault(changeset.id, changeset)
+        byhex.setdefault(changeset.hex, changeset)
+
+    for changeset in changesets:
+        changeset.prefetched_parents = []
+        changeset.prefetched_children = []
+    for (id, hex) in parents:
+        byid[id].prefetched_parents.append(byhex.get(hex, None))
+    for (id, hex) in children:
+        byhex[hex].prefetched_children.append(byid[id])
+    return changesets
+
+class ChangesetGraph(object):
+    hexes = None
+    indexes = None
+    ids = None
+    parent_offsets = None
+    parent_list = None
+    child_offsets = None
+    child_list = None
+
+    # The parent edges of the changesets pushed to a repository, loaded in two
+    # queries and held in memory. Hexes are interned as indexes into hexes so
+    # the edges are two arrays of ints for each direction, the edges of a
+    # changeset being the slice between its offset and the next one. Parents
+    # outside of the repository's window have an index but no id or parents.
+    def __init__(self, repository):
+        self.hexes = []
+        self.indexes = dict()
+        self.ids = array("l")
+
+        pushed = PushChangeset.objects.filter(push__repository = repository)
+        for (id, hex) in pushed.order_by("push__push_id", "index").values_list("changeset_id", "changeset__hex"):
+            self.ids[self.intern(hex)] = id
+
+        edges = ChangesetParent.objects.filter(changeset__pushes__push__repository = repository)
+        byid = dict((id, index) for (index, id) in enumerate(self.ids))
+        pairs = [(byid[id], self.intern(hex)) for (id, hex) in edges.order_by("id").distinct().values_list("changeset_id", "parenthex")]
+
+        (self.parent_offsets, self.parent_list) = self.compress(pairs)
+        (self.child_offsets, self.child_list) = self.compress([(parent, child) for (child, parent) in pairs])
+
+    def intern(self, hex):
+        node = unhexlify(hex)
+        index = self.indexes.get(node, None)
+        if index is None:
+            index = len(self.hexes)
+            self.hexes.append(node)
+            self.indexes[node] = index
+            self.ids.append(0)
+        return index
+
+    def compress(self, pairs):
+        # Orders the pairs by their first index, keeping the order among
+        # equals, and returns the offsets of each index and the second indexes
+        pairs.sort(key = lambda p: p[0])
+        offsets = array("l", [0] * (len(self.hexes) + 1))
+        for (source, target) in pairs:
+            offsets[source + 1] = offsets[source + 1] + 1
+        for i in range(len(self.hexes)):
+            offsets[i + 1] = offsets[i + 1] + offsets[i]
+        return (offsets, array("l", [target for (source, target) in pairs]))
+
+    def __len__(self):
+        return len(self.hexes)
+
+    def __contains__(self, hex):
+        return unhexlify(hex) in self.indexes
+
+    def index(self, hex):
+        return self.indexes[unhexlify(hex)]
+
+    def hex(self, index):
+        return hexlify(self.hexes[index])
+
+    # The id of the Changeset, None if it is outside of the window
+    def changeset_id(self, hex):
+        return self.ids[self.index(hex)] or None
+
+    def parent_indexes(self, index):
+        return self.parent_list[self.parent_offsets[index]:self.parent_offsets[index + 1]]
+
+    def child_indexes(self, index):
+        return self.child_list[self.child_offsets[index]:self.child_offsets[index + 1]]
+
+    def parents(self, hex):
+        return [self.hex(i) for i in self.parent_indexes(self.index(hex))]
+
+    def children(self, hex):
+        return [self.hex(i) for i in self.child_indexes(self.index(hex))]
+
+    def is_merge(self, hex):
+        return len(self.parent_indexes(self.index(hex))) > 1
+
+    def ancestors(self, hex, limit = None):
+        # The ancestors nearest first, stopping at the edge of the window
+        seen = set([self.index(hex)])
+        pending = deque(seen)
+        count = 0
+        while len(pending) > 0:
+            for parent in self.parent_indexes(pending.popleft()):
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                pending.append(parent)
+                yield self.hex(parent)
+                count = count + 1
+                if count == limit:
+                    return
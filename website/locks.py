@@ -0,0 +1,36 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import fcntl
+import os
+import tempfile
+
+from website.config import config_value
+
+class FileLock(object):
+    path = None
+    file = None
+
+    # An exclusive lock shared by every process on this machine.
+    def __init__(self, name):
+        self.path = os.path.join(config_value("lockdir", tempfile.gettempdir()), "hgchangefeed-%s.lock" % name)
+
+    def acquire(self, blocking = True):
+        self.file = open(self.path, "a+")
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags = flags | fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(self.file, flags)
+            return True
+        except IOError:
+            self.file.close()
+            self.file = None
+            return False
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import cPickle
+import os
+import tempfile
+import time
+import zlib
+
+from website.config import config_value
+from website.management.patch import Patch
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "hgchangefeed-cache")
+# The default maximum size of the cache in megabytes
+CACHE_SIZE = 1024
+# The minimum number of seconds between scans of the cache for eviction
+PRUNE_INTERVAL = 3600
+PRUNE_MARKER = "pruned"
+
+class PatchCache(object):
+    directory = None
+    max_size = None
+    written = None
+
+    # A compressed on-disk cache of parsed patches shared by every repository.
+    # Entries are keyed by changeset hex, or by parent and changeset hex for the
+    # extra diffs of merges. Loading an entry marks it as recently used and the
+    # least recently used entries are evicted by prune() once the cache grows
+    # beyond max_size bytes. Scanning a large cache is slow so maybe_prune()
+    # only does so periodically.
+    def __init__(self, directory = None, max_size = None):
+        self.directory = directory if directory is not None else config_value("cachedir", CACHE_DIR)
+        self.max_size = max_size if max_size is not None else config_value("cachesize", CACHE_SIZE) * 1048576
+        self.written = 0
+
+    def filename(self, cset, parent = None):
+        name = cset if parent is None else "%s.%s" % (cset, parent)
+        return os.path.join(self.directory, cset[0:2], name)
+
+    def load(self, cset, parent = None):
+        filename = self.filename(cset, parent)
+        try:
+            with open(filename, "rb") as file:
+                data = cPickle.loads(zlib.decompress(file.read()))
+            os.utime(filename, None)
+            return Patch.from_dict(data)
+        except (IOError, OSError, EOFError, zlib.error, cPickle.UnpicklingError):
+            return None
+
+    def store(self, patch, parent = None):
+        filename = self.filename(patch.hex, parent)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have just created it
+                pass
+
+        data = zlib.compress(cPickle.dumps(patch.to_dict(), cPickle.HIGHEST_PROTOCOL))
+
+        # Written to a temporary file first so a partial entry is never seen
+        (fd, temp) = tempfile.mkstemp(dir = directory)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.rename(temp, filename)
+        self.written = self.written + len(data)
+
+    def maybe_prune(self):
+        if self.written == 0:
+            return
+
+        marker = os.path.join(self.directory, PRUNE_MARKER)
+        try:
+            if time.time() - os.path.getmtime(marker) < PRUNE_INTERVAL:
+                return
+        except OSError:
+            pass
+
+        with open(marker, "w"):
+            pass
+        self.prune()
+
+    def prune(self):
+        entries = []
+        total = 0
+        for (path, dirs, files) in os.walk(self.directory):
+            for name in files:
+                if path == self.directory:
+                    continue
+                filename = os.path.join(path, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total = total + stat.st_size
+
+        entries.sort()
+        for (mtime, size, filename) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total = total - size
+
+        self.written = 0
@@ -0,0 +1,40 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import transaction
+
+from website.models import *
+from website.management.command import UICommand
+from website.management.writer import path_changesets
+
+CHUNK = 500
+
+@transaction.commit_on_success()
+def add_links(repository, root, links):
+    PathChangeset.objects.bulk_create(path_changesets(repository, root, links))
+
+class Command(UICommand):
+    help = "Rebuilds the path index of the given repositories, or of all of them."
+    args = "[name ...]"
+
+    def handle(self, *args, **kwargs):
+        if len(args) > 0:
+            repositories = [Repository.objects.get(name = name) for name in args]
+        else:
+            repositories = list(Repository.objects.all())
+        root = Path.objects.get(parent = None)
+
+        for repository in repositories:
+            with transaction.commit_on_success():
+                PathChangeset.objects.filter(repository = repository).delete()
+
+            # Newest first so the views only use the index once it is complete
+            links = list(PushChangeset.objects.filter(push__repository = repository)
+                                              .order_by("-push__push_id", "-index")
+                                              .values_list("push__push_id", "changeset_id", "index"))
+            for i in range(0, len(links), CHUNK):
+                self.progress("indexing %s" % repository, i, len(links))
+                add_links(repository, root, links[i:i + CHUNK])
+            self.progress("indexing %s" % repository)
+            self.status("indexed %d changesets in %s\n" % (len(links), repository))
@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import connection, transaction
+
+from website.models import *
+from website.management.command import UICommand
+
+CHUNK = 500
+
+@transaction.commit_on_success()
+def update_paths(rows):
+    table = connection.ops.quote_name(Path._meta.db_table)
+    cursor = connection.cursor()
+    cursor.executemany("UPDATE %s SET path = %%s, path_hash = %%s, depth = %%s WHERE id = %%s" % table, rows)
+    transaction.set_dirty()
+
+class Command(UICommand):
+    help = "Fills in the full path and depth of every path."
+
+    def handle(self, *args, **kwargs):
+        total = Path.objects.count()
+
+        # Walks the tree a level at a time so the path of each parent is known
+        # before its children are updated
+        root = Path.objects.get(parent = None)
+        update_paths([("", path_hash(""), 0, root.id)])
+        level = { root.id: "" }
+        complete = 1
+        depth = 0
+
+        while len(level) > 0:
+            depth = depth + 1
+            parents = level.keys()
+            children = dict()
+            for i in range(0, len(parents), CHUNK):
+                self.progress("filling in paths", complete, total)
+                rows = []
+                for (id, name, parent) in Path.objects.filter(parent__in = parents[i:i + CHUNK]).values_list("id", "name", "parent_id"):
+                    fullpath = join_path(level[parent], name)
+                    children[id] = fullpath
+                    rows.append((fullpath, path_hash(fullpath), depth, id))
+
+                for j in range(0, len(rows), CHUNK):
+                    update_paths(rows[j:j + CHUNK])
+                complete = complete + len(rows)
+
+            level = children
+
+        self.progress("filling in paths")
+        self.status("filled in %d paths\n" % complete)
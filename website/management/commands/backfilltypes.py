@@ -0,0 +1,38 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import connection, transaction
+from django.db.models import Count
+
+from website.models import *
+from website.management.command import UICommand
+
+CHUNK = 500
+
+@transaction.commit_on_success()
+def update_changesets(rows):
+    table = connection.ops.quote_name(Changeset._meta.db_table)
+    cursor = connection.cursor()
+    cursor.executemany("UPDATE %s SET types = %%s, change_count = %%s WHERE id = %%s" % table, rows)
+    transaction.set_dirty()
+
+class Command(UICommand):
+    help = "Fills in the types and number of changes of every changeset indexed before they were stored."
+
+    def handle(self, *args, **kwargs):
+        ids = list(Changeset.objects.filter(types = None).values_list("id", flat = True))
+
+        for i in range(0, len(ids), CHUNK):
+            self.progress("filling in changesets", i, len(ids))
+            chunk = ids[i:i + CHUNK]
+            masks = dict((id, 0) for id in chunk)
+            counts = dict((id, 0) for id in chunk)
+            changes = Change.objects.filter(changeset__in = chunk).values("changeset", "type").annotate(count = Count("id"))
+            for change in changes.order_by():
+                masks[change["changeset"]] = masks[change["changeset"]] | CHANGE_MASKS[change["type"]]
+                counts[change["changeset"]] = counts[change["changeset"]] + change["count"]
+            update_changesets([(masks[id], counts[id], id) for id in chunk])
+
+        self.progress("filling in changesets")
+        self.status("filled in %d changesets\n" % len(ids))
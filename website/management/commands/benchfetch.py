@@ -0,0 +1,218 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from website.management.command import UICommand
+from website.management.http import http_fetch, FetchEngine, HttpQueue, OrderedHttpQueue, HTTP_THREADS
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread, Lock, Condition, active_count
+from Queue import Queue
+from optparse import make_option
+import sys
+import time
+
+class TestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = "x" * self.server.size
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    latency = None
+    size = None
+
+    def __init__(self, latency, size):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), TestHandler)
+        self.latency = latency
+        self.size = size
+
+# The queues as they were before the fetch engine, each starting its own
+# threads that never exit, kept here as the baseline to compare against.
+class ThreadedHttpQueue(object):
+    def __init__(self, threads = HTTP_THREADS):
+        self.fetch_queue = Queue()
+        self.response_queue = Queue()
+        self.lock = Lock()
+        self.pending_count = 0
+
+        for i in range(threads):
+             t = Thread(target = self.worker)
+             t.daemon = True
+             t.start()
+
+    def worker(self):
+        while True:
+            (url, context) = self.fetch_queue.get(True)
+            data = None
+            error = None
+            try:
+                data = http_fetch(url)
+            except:
+                error = sys.exc_info()
+            # Unlike the original both happen under the lock, otherwise next()
+            # can see the response taken but the fetch still pending and block
+            with self.lock:
+                self.response_queue.put((data, context, error))
+                self.pending_count = self.pending_count - 1
+
+    def fetch(self, url, context = None):
+        with self.lock:
+            self.pending_count = self.pending_count + 1
+        self.fetch_queue.put((url, context))
+
+    def next(self):
+        with self.lock:
+            if self.pending_count == 0 and self.response_queue.empty():
+                return (None, None)
+        (data, context, error) = self.response_queue.get(True)
+        if error:
+            raise error[0], error[1], error[2]
+        return (data, context)
+
+class ThreadedOrderedHttpQueue(object):
+    def __init__(self, threads = HTTP_THREADS):
+        self.lock = Condition()
+        self.fetch_list = []
+        self.response_list = []
+        self.next_fetch = 0
+        self.next_response = 0
+
+        for i in range(threads):
+             t = Thread(target = self.worker)
+             t.daemon = True
+             t.start()
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while self.next_fetch >= len(self.fetch_list):
+                    self.lock.wait()
+                id = self.next_fetch
+                (url, context) = self.fetch_list[id]
+                self.next_fetch = self.next_fetch + 1
+
+            data = None
+            error = None
+            try:
+                data = http_fetch(url)
+            except:
+                error = sys.exc_info()
+
+            with self.lock:
+                self.response_list[id] = (data, context, error)
+                self.lock.notifyAll()
+
+    def fetch(self, url, context = None):
+        with self.lock:
+            self.fetch_list.append((url, context))
+            self.response_list.append(None)
+            self.lock.notifyAll()
+
+    def next(self):
+        with self.lock:
+            if self.next_response >= len(self.response_list):
+                return (None, None)
+            while self.response_list[self.next_response] is None:
+                self.lock.wait()
+            (data, context, error) = self.response_list[self.next_response]
+            self.response_list[self.next_response] = None
+            self.next_response = self.next_response + 1
+        if error:
+            raise error[0], error[1], error[2]
+        return (data, context)
+
+class Command(UICommand):
+    help = "Compares the fetch engine with the threaded queues against a local test server."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--requests",
+            dest = "requests",
+            type = "int",
+            default = 2000,
+            help = "The number of requests made by each queue."
+        ),
+        make_option("--queues",
+            dest = "queues",
+            type = "int",
+            default = 4,
+            help = "The number of queues created for each run."
+        ),
+        make_option("--threads",
+            dest = "threads",
+            type = "int",
+            default = HTTP_THREADS,
+            help = "The number of concurrent requests."
+        ),
+        make_option("--latency",
+            dest = "latency",
+            type = "float",
+            default = 0.01,
+            help = "The number of seconds the server waits before each response."
+        ),
+        make_option("--size",
+            dest = "size",
+            type = "int",
+            default = 16384,
+            help = "The size of each response in bytes."
+        ),
+    )
+
+    def run(self, name, create, queues, requests, url):
+        threads = active_count()
+        start = time.time()
+        for i in range(queues):
+            queue = create()
+            for j in range(requests):
+                queue.fetch("%s%d" % (url, j), j)
+
+            count = 0
+            (data, context) = queue.next()
+            while data is not None:
+                count = count + 1
+                (data, context) = queue.next()
+            if count != requests:
+                raise CommandError("%s returned %d of %d responses" % (name, count, requests))
+        elapsed = time.time() - start
+
+        total = queues * requests
+        self.status("%s: %.3fs, %.0f requests/s, %d threads left running\n" %
+                    (name, elapsed, total / elapsed, active_count() - threads))
+
+    def handle(self, *args, **kwargs):
+        server = TestServer(kwargs["latency"], kwargs["size"])
+        thread = Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        url = "http://127.0.0.1:%d/" % server.server_address[1]
+        threads = kwargs["threads"]
+        engine = FetchEngine(threads = threads, host_limit = threads)
+
+        runs = (
+            ("threaded unordered", lambda: ThreadedHttpQueue(threads = threads)),
+            ("threaded ordered", lambda: ThreadedOrderedHttpQueue(threads = threads)),
+            ("engine unordered", lambda: HttpQueue(concurrency = threads, engine = engine)),
+            ("engine ordered", lambda: OrderedHttpQueue(concurrency = threads, engine = engine)),
+        )
+
+        try:
+            for (name, create) in runs:
+                self.run(name, create, kwargs["queues"], kwargs["requests"], url)
+        finally:
+            engine.shutdown()
+            server.shutdown()
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from base.utils import config
+
+from website.config import config_value
+from website.models import *
+from website.management.command import UICommand
+from website.management.http import get_client
+from website.management.repo import update_repository
+from website.management.standin import StandinServer, Corpus, generate_corpus, record_corpus
+from website.management.commands.initrepo import add_paths
+
+from datetime import datetime, timedelta
+from optparse import make_option
+from pytz import utc
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+class QueryCounter(list):
+    count = 0
+
+    # Stands in for the connection's query log, counting without keeping them
+    def append(self, query):
+        self.count = self.count + 1
+
+class Command(UICommand):
+    help = "Measures indexing a recorded or generated corpus served by a local stand-in for hgweb."
+    args = "corpus"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--record",
+            dest = "record",
+            default = None,
+            help = "Record the corpus from this repository URL first."
+        ),
+        make_option("--start",
+            dest = "start",
+            type = "int",
+            default = None,
+            help = "The push id to start recording after."
+        ),
+        make_option("--generate",
+            dest = "generate",
+            type = "int",
+            default = None,
+            help = "Generate a corpus with this many pushes first."
+        ),
+        make_option("--files",
+            dest = "files",
+            type = "int",
+            default = 2000,
+            help = "The number of files in a generated corpus."
+        ),
+        make_option("--latency",
+            dest = "latency",
+            type = "float",
+            default = 0,
+            help = "The number of seconds the server waits before each response."
+        ),
+        make_option("--errors",
+            dest = "errors",
+            type = "float",
+            default = 0,
+            help = "The fraction of requests that fail with a server error."
+        ),
+    )
+
+    def measure(self, name, count, run):
+        counter = QueryCounter()
+        connection.use_debug_cursor = True
+        connection.queries = counter
+        client = get_client()
+        client.reset_stats()
+
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+
+        connection.use_debug_cursor = None
+        connection.queries = []
+        items = count()
+        self.status("%s: %d in %.2fs, %.1f/s, %d queries, %d requests, peak memory %.1f MB\n" %
+                    (name, items, elapsed, items / elapsed, counter.count, client.requests,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        return items
+
+    def handle(self, *args, **kwargs):
+        if len(args) != 1:
+            raise CommandError("You must provide the directory for the corpus.")
+        directory = args[0]
+
+        if kwargs["record"]:
+            url = kwargs["record"]
+            if url[-1] != '/':
+                url = url + '/'
+            record_corpus(self, url, directory, kwargs["start"])
+        elif kwargs["generate"]:
+            generate_corpus(directory, pushes = kwargs["generate"], files = kwargs["files"])
+
+        if not os.path.isdir(directory):
+            raise CommandError("%s does not exist." % directory)
+
+        corpus = Corpus(directory)
+        server = StandinServer(corpus, kwargs["latency"], kwargs["errors"])
+        server.start()
+
+        # Everything is written to a throwaway database and patch cache
+        if not config.has_section("hgchangefeed"):
+            config.add_section("hgchangefeed")
+        cachedir = config_value("cachedir")
+        config.set("hgchangefeed", "cachedir", tempfile.mkdtemp())
+        database = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+        try:
+            oldest = corpus.oldest() - timedelta(days = 1)
+            keep = int((datetime.now(utc) - oldest).total_seconds())
+            repository = Repository(name = "standin", url = server.url, range = keep)
+            repository.save()
+
+            self.measure("paths", lambda: Path.objects.count(), lambda: add_paths(self, repository))
+            changesets = self.measure("changesets", lambda: Changeset.objects.count(),
+                                      lambda: update_repository(self, repository))
+            if changesets != corpus.changeset_count():
+                raise CommandError("Indexed %d of %d changesets" % (changesets, corpus.changeset_count()))
+
+            self.measure("no-op update", lambda: Push.objects.count(),
+                         lambda: update_repository(self, repository))
+            self.status("served %d requests, injected %d errors\n" % (server.requests, server.errors))
+        finally:
+            connection.creation.destroy_test_db(database, verbosity = 0)
+            server.stop()
+            shutil.rmtree(config_value("cachedir"), True)
+            if cachedir is None:
+                config.remove_option("hgchangefeed", "cachedir")
+            else:
+                config.set("hgchangefeed", "cachedir", cachedir)
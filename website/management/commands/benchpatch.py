@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from website.management.command import UICommand
+from website.management.patch import Patch, read_patch
+
+from optparse import make_option
+import os
+import time
+
+def parse_split(filename):
+    with open(filename, "rb") as file:
+        return Patch(file.read().split("\n"))
+
+def parse_stream(filename):
+    with open(filename, "rb") as file:
+        return read_patch(file)
+
+PARSERS = (
+    ("split", parse_split),
+    ("stream", parse_stream),
+)
+
+RESULTS = ("hex", "user", "date", "parents", "description", "files", "added", "removed", "modified")
+
+class Command(UICommand):
+    help = "Compares the speed of the patch parsers on recorded patches."
+    args = "patch [patch ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat",
+            dest = "repeat",
+            type = "int",
+            default = 5,
+            help = "The number of times to parse each patch."
+        ),
+    )
+
+    def handle(self, *args, **kwargs):
+        if len(args) == 0:
+            raise CommandError("You must provide at least one recorded patch.")
+
+        size = sum(os.path.getsize(f) for f in args)
+        repeat = kwargs["repeat"]
+
+        for filename in args:
+            patches = [parser(filename) for (name, parser) in PARSERS]
+            for attr in RESULTS:
+                values = [getattr(p, attr) for p in patches]
+                if any(v != values[0] for v in values):
+                    raise CommandError("Parsers disagree on %s for %s" % (attr, filename))
+
+        for (name, parser) in PARSERS:
+            start = time.time()
+            for i in range(repeat):
+                for filename in args:
+                    parser(filename)
+            elapsed = time.time() - start
+
+            self.status("%s: %.3fs, %.1f MB/s\n" % (name, elapsed / repeat, size * repeat / elapsed / 1048576))
@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from website.models import *
+from website.management.command import UICommand
+
+from optparse import make_option
+import time
+
+class Command(UICommand):
+    help = "Compares finding the changesets beneath directories through the ancestors, the intervals and the path index."
+    args = "repository"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--dirs",
+            dest = "dirs",
+            type = "int",
+            default = 20,
+            help = "The number of directories to query, the ones with the most changes first."
+        ),
+        make_option("--repeat",
+            dest = "repeat",
+            type = "int",
+            default = 5,
+            help = "The number of times each query is run."
+        ),
+    )
+
+    def join(self, repository, params):
+        # The query the path view made before the path index
+        changesets = Changeset.objects.filter(pushes__push__repository = repository, **params)
+        changesets = changesets.distinct().order_by("-pushes__push__push_id", "-pushes__index")
+        return [c.id for c in changesets[:200]]
+
+    def index(self, repository, path):
+        entries = PathChangeset.objects.filter(repository = repository, path = path).order_by("-push_id", "-index")
+        return [e.changeset_id for e in entries[:200]]
+
+    def measure(self, name, paths, query, repeat):
+        results = []
+        start = time.time()
+        for i in range(repeat):
+            results = [query(p) for p in paths]
+        elapsed = time.time() - start
+        self.status("%s: %d queries in %.3fs, %.2fms each\n" %
+                    (name, repeat * len(paths), elapsed, elapsed * 1000 / (repeat * len(paths))))
+        return results
+
+    def handle(self, *args, **kwargs):
+        if len(args) != 1:
+            raise CommandError("You must provide the name of the repository.")
+        repository = Repository.objects.get(name = args[0])
+
+        dirs = Path.objects.filter(is_dir = True, parent__isnull = False, repositories = repository)
+        if dirs.filter(lft__isnull = True).exists():
+            raise CommandError("The intervals must be built with rebuildintervals first.")
+
+        # The directories with the most changes beneath them
+        ancestors = Ancestor.objects.filter(ancestor__in = dirs, path__changes__changeset__pushes__push__repository = repository)
+        counts = ancestors.values("ancestor").annotate(changes = Count("path__changes")).order_by("-changes")
+        paths = list(Path.objects.filter(id__in = [c["ancestor"] for c in counts[:kwargs["dirs"]]]))
+        if len(paths) == 0:
+            raise CommandError("%s has no changes to query." % repository)
+
+        repeat = kwargs["repeat"]
+        ancestors = self.measure("ancestors", paths,
+                                 lambda p: self.join(repository, { "changes__path__ancestors__ancestor": p }), repeat)
+        intervals = self.measure("intervals", paths,
+                                 lambda p: self.join(repository, p.subtree_filter("changes__path")), repeat)
+        index = self.measure("path index", paths, lambda p: self.index(repository, p), repeat)
+        if ancestors != intervals or ancestors != index:
+            raise CommandError("The queries found different changesets.")
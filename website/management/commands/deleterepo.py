@@ -3,16 +3,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
-from django.db import transaction
 
 from website.models import *
 from website.management.command import UICommand
+from website.management.delete import delete_pushes, delete_orphan_changesets, unlink_paths, delete_orphan_paths
 
 from optparse import make_option
 
-DATABASE_ENGINE = settings.DATABASES['default']['ENGINE']
-
 class Command(UICommand):
     help = "Delete an existing repository."
     args = "name"
@@ -26,7 +23,6 @@ class Command(UICommand):
         ),
     )
 
-    @transaction.commit_on_success()
     def handle(self, *args, **kwargs):
         if len(args) != 1:
             raise CommandError("You must provide the name for the repository.")
@@ -35,53 +31,17 @@ class Command(UICommand):
         try:
             repository = Repository.objects.get(name = name)
 
-            pushes = Push.objects.filter(repository = repository)
-            self.status("deleting %d pushes\n" % len(pushes))
-            pushes.delete()
-
-            if DATABASE_ENGINE == 'django.db.backends.sqlite3':
-                # A bug in django makes it impossible to delete a large set of objects
-                # that are referenced by foreign keys, delete them one at a time for
-                # safety. See https://code.djangoproject.com/ticket/16426
-                changeset_count = Changeset.objects.filter(pushes__isnull = True).count()
-                remains = changeset_count
-                count = 0
-                while (remains - count) > 0:
-                    changesets = Changeset.objects.filter(pushes__isnull = True)[:500]
-                    self.progress("deleting changesets", count, total = changeset_count)
-                    for changeset in changesets:
-                        changeset.delete()
-                    count = count + len(changesets)
-                self.progress("deleting changesets")
-            else:
-                changesets = Changeset.objects.filter(pushes__isnull = True)
-                self.status("deleting %d changesets\n" % len(changesets))
-                changesets.delete()
+            delete_pushes(self, repository)
+            delete_orphan_changesets(self)
 
             if kwargs["onlychangesets"]:
                 return
 
+            unlink_paths(self, repository)
             repository.delete()
             self.status("repository deleted\n")
 
-            if DATABASE_ENGINE == 'django.db.backends.sqlite3':
-                # A bug in django makes it impossible to delete a large set of objects
-                # that are referenced by foreign keys, delete them one at a time for
-                # safety. See https://code.djangoproject.com/ticket/16426
-                path_count = Path.objects.filter(repositories__isnull = True).count()
-                remains = path_count
-                count = 0
-                while (remains - count) > 0:
-                    paths = Path.objects.filter(repositories__isnull = True).order_by("id")[:500]
-                    self.progress("deleting paths", count, total = path_count)
-                    for path in paths:
-                        path.delete()
-                    count = count + len(paths)
-                self.progress("deleting paths")
-            else:
-                paths = Path.objects.filter(repositories__isnull = True)
-                self.status("deleting %d paths\n" % len(paths))
-                paths.delete()
+            delete_orphan_paths(self)
 
         except Repository.DoesNotExist:
             raise Exception("Repository doesn't exist in the database")
@@ -3,27 +3,28 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import connection, transaction
 
 from website.models import *
 from website.management.command import UICommand
-from website.management.http import HttpQueue
+from website.management.http import http_fetch, HttpQueue, HTTP_THREADS
+from website.management.paths import PathResolver
+from website.config import config_value
 from website.management.repo import fetch_pushes
+from website.management.local import open_source, HgCloneSource
 
 from optparse import make_option
 import re
 
 DEFAULT_RANGE = 604800
+# The number of rows to stage before writing them to the database
+PATH_BATCH = 20000
 
-@transaction.commit_on_success()
+@transaction.commit_manually()
 def add_paths(ui, repository):
-    root = repository.root
-
-    pushes = fetch_pushes(repository.url)
-    cset = pushes[-1]['changesets'][-1]
-
-    queue = HttpQueue()
-    queue.fetch("%sfile/%s/?style=raw" % (repository.url, cset), [root])
+    # The tree is built up in memory by the resolver and written in large
+    # batches while the directory listings are fetched concurrently.
+    resolver = PathResolver(repository)
 
     totalpaths = 1
     complete = 0
@@ -31,12 +32,14 @@ def add_paths(ui, repository):
     ui.progress("indexing paths", complete, totalpaths)
 
     try:
-        (response, parentlist) = queue.next()
-        while response:
-            directory = parentlist[-1]
-            paths = Path.objects.filter(parent = directory)
-            contents = { p.name: p for p in paths}
+        pushes = fetch_pushes(ui, repository.url)
+        cset = pushes[-1]['changesets'][-1]
 
+        queue = HttpQueue(concurrency = config_value("fetchthreads", HTTP_THREADS))
+        queue.fetch("%sfile/%s/?style=raw" % (repository.url, cset), "")
+
+        (response, directory) = queue.next()
+        while response:
             for line in response.split("\n"):
                 line = line.strip()
                 if len(line) == 0:
@@ -47,36 +50,23 @@ def add_paths(ui, repository):
 
                 is_dir = matches.group(1) == 'd'
                 name = matches.group(2) if is_dir else matches.group(3)
+                fullpath = name if directory == "" else "%s/%s" % (directory, name)
 
-                if name in contents:
-                    path = contents[name]
-                else:
-                    path = Path(id = Path.next_id(), name = name, parent = directory, is_dir = is_dir)
-                    path.save()
-                    added = added + 1
-
-                    depth = len(parentlist)
-                    ancestors = []
-                    for ancestor in parentlist:
-                        ancestors.append(Ancestor(path = path, ancestor = ancestor, depth = depth))
-                        depth = depth - 1
-                    ancestors.append(Ancestor(path = path, ancestor = path, depth = 0))
-                    Ancestor.objects.bulk_create(ancestors)
-
-                path.repositories.add(repository)
+                resolver.get_path(fullpath, is_dir)
 
                 if is_dir:
-                    newlist = list(parentlist)
-                    newlist.append(path)
-                    fullpath = "/".join([p.name for p in newlist[1:]])
-                    queue.fetch("%sfile/%s/%s/?style=raw" % (repository.url, cset, fullpath), newlist)
+                    queue.fetch("%sfile/%s/%s/?style=raw" % (repository.url, cset, fullpath), fullpath)
                     totalpaths = totalpaths + 1
 
             complete = complete + 1
-            transaction.commit()
+            if resolver.staged() >= PATH_BATCH:
+                added = added + resolver.flush()
+                transaction.commit()
             ui.progress("indexing paths", complete, totalpaths)
-            (response, parentlist) = queue.next()
+            (response, directory) = queue.next()
 
+        added = added + resolver.flush()
+        transaction.commit()
     except:
         ui.traceback()
         transaction.rollback()
@@ -84,6 +74,60 @@ def add_paths(ui, repository):
         ui.progress("indexing paths")
         ui.status("added %d paths\n" % added)
 
+def read_manifest(ui, source):
+    if source.startswith("http://") or source.startswith("https://"):
+        ui.log("fetching manifest: %s\n" % source)
+        return http_fetch(source).split("\n")
+    return open(source, "rb")
+
+@transaction.commit_manually()
+def add_manifest(ui, repository, lines):
+    # Loads the tree from a flat manifest, one file path per line as output by
+    # "hg manifest". Directories are derived from the file paths.
+    resolver = PathResolver(repository)
+
+    files = 0
+    added = 0
+    ui.progress("indexing files", files)
+
+    try:
+        for line in lines:
+            path = line.rstrip("\r\n")
+            if len(path) == 0:
+                continue
+
+            resolver.get_path(path)
+            files = files + 1
+
+            if resolver.staged() >= PATH_BATCH:
+                added = added + resolver.flush()
+                transaction.commit()
+                ui.progress("indexing files", files)
+
+        added = added + resolver.flush()
+        transaction.commit()
+    except:
+        ui.traceback()
+        transaction.rollback()
+    finally:
+        ui.progress("indexing files")
+        ui.status("added %d paths\n" % added)
+
+@transaction.commit_on_success()
+def copy_paths(ui, repository, related):
+    # Links every path in the related repository to this one with a single
+    # statement, skipping any that are already linked.
+    through = Path.repositories.through
+    table = connection.ops.quote_name(through._meta.db_table)
+
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO %s (path_id, repository_id) "
+                   "SELECT t.path_id, %%s FROM %s t WHERE t.repository_id = %%s "
+                   "AND NOT EXISTS (SELECT 1 FROM %s e WHERE e.path_id = t.path_id AND e.repository_id = %%s)" %
+                   (table, table, table), [repository.id, related.id, repository.id])
+    transaction.set_dirty()
+    ui.status("copied %d paths\n" % cursor.rowcount)
+
 class Command(UICommand):
     help = "Add a new repository."
     args = "name url"
@@ -99,6 +143,16 @@ class Command(UICommand):
             default = None,
             help = "The name of a related repository to load the file structure from."
         ),
+        make_option("--manifest",
+            dest = "manifest",
+            default = None,
+            help = "A file or URL holding the repository's manifest to load the file structure from."
+        ),
+        make_option("--source",
+            dest = "source",
+            default = None,
+            help = "A local clone of the repository to load the file structure from."
+        ),
     )
 
     def handle(self, *args, **kwargs):
@@ -118,18 +172,20 @@ class Command(UICommand):
         if kwargs["related"]:
             try:
                 related = Repository.objects.get(name = kwargs["related"])
-
-                paths = Path.objects.filter(repositories = related)
-                CHUNK = 500
-                count = 0
-                while count < len(paths):
-                    self.progress("copying paths", count, len(paths))
-                    items = paths[count:count + CHUNK]
-                    repository.paths.add(*items)
-                    count = count + len(items)
-                self.progress("copying paths")
+                copy_paths(self, repository, related)
                 return
             except Repository.DoesNotExist:
-                self.warn("Unknown repository %s, loading file structure from source\n" % args["related"])
+                self.warn("Unknown repository %s, loading file structure from source\n" % kwargs["related"])
+
+        if kwargs["manifest"]:
+            add_manifest(self, repository, read_manifest(self, kwargs["manifest"]))
+            return
+
+        if kwargs["source"]:
+            source = open_source(kwargs["source"])
+            if isinstance(source, HgCloneSource):
+                add_manifest(self, repository, source.manifest(self))
+                return
+            self.warn("%s is not a clone, loading file structure from %s\n" % (kwargs["source"], repository.url))
 
         add_paths(self, repository)
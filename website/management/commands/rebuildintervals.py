@@ -0,0 +1,17 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import transaction
+
+from website.models import *
+from website.management.command import UICommand
+from website.management.paths import rebuild_intervals
+
+class Command(UICommand):
+    help = "Renumbers the intervals of every path."
+
+    def handle(self, *args, **kwargs):
+        with transaction.commit_on_success():
+            count = rebuild_intervals(self)
+        self.status("renumbered %d paths\n" % count)
@@ -2,13 +2,57 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand, CommandError, OutputWrapper
+from django.db import connection
 
 from website.models import *
 from website.management.command import UICommand
 from website.management.repo import update_repository
 
+from multiprocessing import Pool
 from optparse import make_option
+import sys
+
+class PrefixedOutput(OutputWrapper):
+    prefix = None
+
+    def __init__(self, out, prefix):
+        super(PrefixedOutput, self).__init__(out)
+        self.prefix = prefix
+
+    def write(self, msg, style_func = None, ending = None):
+        super(PrefixedOutput, self).write("%s: %s" % (self.prefix, msg), style_func, ending)
+
+class JobUI(UICommand):
+    # Output for a repository updated in a worker process. Lines are prefixed
+    # with the repository name and progress is hidden as it would interleave
+    # with the other workers.
+    def __init__(self, name, verbosity):
+        super(JobUI, self).__init__()
+        self.verbosity = verbosity
+        self.stdout = PrefixedOutput(sys.stdout, name)
+        self.stderr = PrefixedOutput(sys.stderr, name)
+
+    def progress(self, str, pos = None, total = None):
+        pass
+
+def init_job():
+    # Nothing inherited from the parent process may be shared between workers
+    connection.close()
+    Path.reset_ids()
+    Change.reset_ids()
+
+def update_job(args):
+    (id, verbosity) = args
+    repository = Repository.objects.get(id = id)
+    ui = JobUI(repository.name, verbosity)
+    try:
+        return update_repository(ui, repository)
+    except:
+        ui.traceback()
+        return None
+    finally:
+        connection.close()
 
 class Command(UICommand):
     help = "Updates all repositories."
@@ -26,17 +70,43 @@ class Command(UICommand):
             default = False,
             help = "Only update visible repositories."
         ),
+        make_option("--jobs",
+            dest = "jobs",
+            type = "int",
+            default = 1,
+            help = "The number of repositories to update at the same time."
+        ),
     )
 
     def handle(self, *args, **kwargs):
         if kwargs["visible"] and kwargs["hidden"]:
             raise CommandError("You cannot pass --hidden and --visible at the same time")
+        if kwargs["jobs"] < 1:
+            raise CommandError("--jobs must be at least 1")
 
         types = dict()
         if kwargs["hidden"] != kwargs["visible"]:
             types["hidden"] = kwargs["hidden"]
 
         repositories = Repository.objects.filter(**types)
-        for repository in repositories:
-            self.status("updating %s\n" % repository.name)
-            update_repository(self, repository)
+        # Each result is the number of new pushes, None if the update failed
+        if kwargs["jobs"] == 1:
+            results = []
+            for repository in repositories:
+                self.status("updating %s\n" % repository.name)
+                results.append(update_repository(self, repository))
+        else:
+            jobs = [(r.id, self.verbosity) for r in repositories]
+            connection.close()
+
+            pool = Pool(kwargs["jobs"], init_job)
+            try:
+                results = list(pool.imap_unordered(update_job, jobs))
+            finally:
+                pool.close()
+                pool.join()
+
+        updated = sum(1 for result in results if result)
+        skipped = sum(1 for result in results if result == 0)
+        self.status("updated %d of %d repositories, skipped %d with no new pushes\n" %
+                    (updated, len(results), skipped))
@@ -7,6 +7,7 @@ from django.core.management.base import BaseCommand, CommandError
 from website.models import *
 from website.management.command import UICommand
 from website.management.repo import update_repository
+from website.management.local import open_source
 
 from optparse import make_option
 
@@ -14,6 +15,14 @@ class Command(UICommand):
     help = "Update an existing repository."
     args = "name"
 
+    option_list = BaseCommand.option_list + (
+        make_option("--source",
+            dest = "source",
+            default = None,
+            help = "A local clone or directory of exported patches to read changesets from."
+        ),
+    )
+
     def handle(self, *args, **kwargs):
         if len(args) != 1:
             raise CommandError("You must provide the name for the repository.")
@@ -22,9 +31,9 @@ class Command(UICommand):
         try:
             repository = Repository.objects.get(name = name)
 
-            update_repository(self, repository)
-
-            repository.hidden = False
-            repository.save()
+            source = open_source(kwargs["source"]) if kwargs["source"] else None
+            if update_repository(self, repository, source) is not None:
+                repository.hidden = False
+                repository.save()
         except Repository.DoesNotExist:
             raise Exception("Repository doesn't exist in the database")
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Deletes large numbers of rows without loading them into Django. The ids to
+# delete are selected once and then removed a chunk at a time, dependent rows
+# first, with plain DELETE statements so that the same SQL works on SQLite and
+# MySQL. Each chunk is committed on its own.
+
+from django.db import connection, transaction
+
+from website.models import *
+
+CHUNK = 500
+
+def table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+def select_rows(sql, params = ()):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def select_ids(sql, params = ()):
+    return [row[0] for row in select_rows(sql, params)]
+
+def delete_in(model, column, ids):
+    placeholders = ", ".join(["%s"] * len(ids))
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (table(model), connection.ops.quote_name(column), placeholders), ids)
+    transaction.set_dirty()
+
+def delete_chunk(ids, steps):
+    with transaction.commit_on_success():
+        for (model, column) in steps:
+            delete_in(model, column, ids)
+
+def delete_ids(ui, name, ids, steps):
+    total = len(ids)
+    for i in range(0, total, CHUNK):
+        ui.progress(name, i, total)
+        delete_chunk(ids[i:i + CHUNK], steps)
+    ui.progress(name)
+
+def delete_pushes(ui, repository):
+    ids = select_ids("SELECT id FROM %s WHERE repository_id = %%s" % table(PathChangeset), [repository.id])
+    delete_ids(ui, "deleting path index", ids, [
+        (PathChangeset, "id"),
+    ])
+
+    ids = select_ids("SELECT id FROM %s WHERE repository_id = %%s" % table(Push), [repository.id])
+    delete_ids(ui, "deleting pushes", ids, [
+        (PushChangeset, "push_id"),
+        (Push, "id"),
+    ])
+    Checkpoint.objects.filter(repository = repository).delete()
+
+def delete_orphan_changesets(ui):
+    ids = select_ids("SELECT c.id FROM %s c LEFT JOIN %s pc ON pc.changeset_id = c.id WHERE pc.id IS NULL" %
+                     (table(Changeset), table(PushChangeset)))
+    delete_ids(ui, "deleting changesets", ids, [
+        (PathChangeset, "changeset_id"),
+        (Change, "changeset_id"),
+        (ChangesetParent, "changeset_id"),
+        (Changeset, "id"),
+    ])
+
+def unlink_paths(ui, repository):
+    through = Path.repositories.through
+    ids = select_ids("SELECT id FROM %s WHERE repository_id = %%s" % table(through), [repository.id])
+    delete_ids(ui, "unlinking paths", ids, [
+        (through, "id"),
+    ])
+
+def delete_orphan_paths(ui):
+    # Paths are deleted deepest first, a single depth per chunk, so a path is
+    # never deleted before its children. The root is always kept.
+    root = Path.objects.get(parent = None)
+    through = Path.repositories.through
+    rows = select_rows("SELECT p.id, a.depth FROM %s p "
+                       "JOIN %s a ON a.path_id = p.id AND a.ancestor_id = %%s "
+                       "LEFT JOIN %s t ON t.path_id = p.id "
+                       "WHERE t.id IS NULL AND p.parent_id IS NOT NULL" %
+                       (table(Path), table(Ancestor), table(through)), [root.id])
+
+    depths = dict()
+    for (id, depth) in rows:
+        depths.setdefault(depth, []).append(id)
+
+    steps = [
+        (PathChangeset, "path_id"),
+        (Change, "path_id"),
+        (Ancestor, "ancestor_id"),
+        (Ancestor, "path_id"),
+        (Path, "id"),
+    ]
+
+    total = len(rows)
+    count = 0
+    for depth in sorted(depths.keys(), reverse = True):
+        ids = depths[depth]
+        for i in range(0, len(ids), CHUNK):
+            ui.progress("deleting paths", count, total)
+            chunk = ids[i:i + CHUNK]
+            delete_chunk(chunk, steps)
+            count = count + len(chunk)
+    ui.progress("deleting paths")
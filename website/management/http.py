@@ -1,131 +1,513 @@
 HTTP_THREADS = 40
 
-import urllib2
-from threading import Thread, Lock, Condition
-from Queue import Queue
+import random
+import socket
+import sys
+import time
+import zlib
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from urlparse import urlsplit, urljoin
+from collections import deque
+from threading import Thread, Lock, Condition, local
 
-def http_fetch(url):
-    while True:
-        try:
-            response = urllib2.urlopen(url)
-            return response.read()
-        except:
+from website.config import config_value
+
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 120
+# The number of times a single request may be retried
+RETRIES = 6
+# The number of retries allowed across every request in a run
+RETRY_BUDGET = 200
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+MAX_REDIRECTS = 5
+# The number of requests that may be made to a single host at once
+HOST_CONNECTIONS = HTTP_THREADS
+# The number of responses a queue may have fetched or in progress at once
+PENDING_RESPONSES = 200
+READ_SIZE = 65536
+
+class HttpError(Exception):
+    # Raised for responses that retrying will not fix
+    status = None
+    url = None
+
+    def __init__(self, status, url):
+        super(HttpError, self).__init__("HTTP %d fetching %s" % (status, url))
+        self.status = status
+        self.url = url
+
+class RetryableError(Exception):
+    pass
+
+class ResponseStream(object):
+    response = None
+    decoder = None
+    buffer = None
+    client = None
+
+    # A file-like wrapper that decodes a gzip or deflate encoded response as
+    # it is read and counts the bytes received.
+    def __init__(self, client, response):
+        self.client = client
+        self.response = response
+        self.buffer = ""
+
+        encoding = (response.getheader("content-encoding") or "").lower()
+        if encoding == "gzip":
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+
+    def read_raw(self, size):
+        data = self.response.read(size)
+        self.client.count_bytes(len(data))
+        return data
+
+    def read(self, size = -1):
+        if self.decoder is None:
+            if size < 0:
+                chunks = []
+                data = self.read_raw(READ_SIZE)
+                while data:
+                    chunks.append(data)
+                    data = self.read_raw(READ_SIZE)
+                return "".join(chunks)
+            return self.read_raw(size)
+
+        while size < 0 or len(self.buffer) < size:
+            data = self.read_raw(READ_SIZE)
+            if not data:
+                self.buffer = self.buffer + self.decoder.flush()
+                break
+            self.buffer = self.buffer + self.decoder.decompress(data)
+
+        if size < 0:
+            (result, self.buffer) = (self.buffer, "")
+        else:
+            (result, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return result
+
+    def getheader(self, name, default = None):
+        return self.response.getheader(name, default)
+
+    # Reads whatever the parser left so the connection can be reused
+    def drain(self):
+        while self.read_raw(READ_SIZE):
             pass
 
-class HttpQueue(object):
-    fetch_queue = None
-    response_queue = None
+class HttpClient(object):
+    connect_timeout = None
+    read_timeout = None
+    retries = None
+    budget = None
+    connections = None
     lock = None
-    pending_count = None
+    requests = None
+    bytes = None
+    retried = None
 
-    def __init__(self):
-        self.fetch_queue = Queue()
-        self.response_queue = Queue()
+    # Makes HTTP requests over persistent connections, one per host for each
+    # thread, asking for compressed responses. Network errors and server
+    # errors are retried with exponential backoff and jitter up to a limit per
+    # request and a shared budget across all requests, other errors are raised
+    # immediately. Counts the requests made and bytes received.
+    def __init__(self, connect_timeout = CONNECT_TIMEOUT, read_timeout = READ_TIMEOUT,
+                 retries = RETRIES, budget = RETRY_BUDGET):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.budget = budget
+        self.connections = local()
         self.lock = Lock()
-        self.pending_count = 0
+        self.reset_stats()
 
-        for i in range(HTTP_THREADS):
-             t = Thread(target = self.worker)
-             t.daemon = True
-             t.start()
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.retried = 0
 
-    def worker(self):
+    def count_bytes(self, count):
+        with self.lock:
+            self.bytes = self.bytes + count
+
+    def connection(self, scheme, netloc):
+        if not hasattr(self.connections, "pool"):
+            self.connections.pool = dict()
+
+        key = (scheme, netloc)
+        if key not in self.connections.pool:
+            if scheme == "https":
+                conn = HTTPSConnection(netloc, timeout = self.connect_timeout)
+            else:
+                conn = HTTPConnection(netloc, timeout = self.connect_timeout)
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            self.connections.pool[key] = conn
+        return self.connections.pool[key]
+
+    def discard(self, scheme, netloc):
+        pool = getattr(self.connections, "pool", dict())
+        conn = pool.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, scheme, netloc, path, url, headers = None):
+        pool = getattr(self.connections, "pool", dict())
+        # The server may have closed a connection that has been idle so a
+        # failure on a reused connection is tried again on a new one
+        attempts = 2 if (scheme, netloc) in pool else 1
+        for attempt in range(attempts):
+            with self.lock:
+                self.requests = self.requests + 1
+
+            try:
+                conn = self.connection(scheme, netloc)
+                request_headers = {
+                    "Accept-Encoding": "gzip, deflate",
+                    "Connection": "keep-alive",
+                }
+                if headers:
+                    request_headers.update(headers)
+                conn.request("GET", path, headers = request_headers)
+                return conn.getresponse()
+            except (socket.error, HTTPException):
+                self.discard(scheme, netloc)
+
+        raise RetryableError("Failed to fetch %s" % url)
+
+    def open(self, url, headers = None):
+        for redirect in range(MAX_REDIRECTS + 1):
+            (scheme, netloc, path, query, fragment) = urlsplit(url)
+            if query:
+                path = "%s?%s" % (path, query)
+
+            response = self.request(scheme, netloc, path or "/", url, headers)
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("location")
+                response.read()
+                if response.will_close:
+                    self.discard(scheme, netloc)
+                url = urljoin(url, location)
+                continue
+
+            # 304 is only seen when the caller asked for a conditional request
+            if response.status not in (200, 304):
+                response.read()
+                self.discard(scheme, netloc)
+                if response.status >= 500:
+                    raise RetryableError("HTTP %d fetching %s" % (response.status, url))
+                raise HttpError(response.status, url)
+
+            return (response, scheme, netloc)
+
+        raise HttpError(response.status, url)
+
+    def backoff(self, attempt, url):
+        with self.lock:
+            if self.retried >= self.budget:
+                return False
+            self.retried = self.retried + 1
+
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+        return True
+
+    # Passes a file-like stream of the decoded response to parser and returns
+    # its result. Errors raised by the parser are not retried. If headers makes
+    # the request conditional and the server responds that nothing has changed
+    # then the parser isn't called and None is returned.
+    def parse(self, url, parser, headers = None):
+        attempt = 0
         while True:
-            (url, context) = self.fetch_queue.get(True)
+            try:
+                (response, scheme, netloc) = self.open(url, headers)
+                if response.status == 304:
+                    response.read()
+                    if response.will_close:
+                        self.discard(scheme, netloc)
+                    return None
 
-            data = http_fetch(url)
+                stream = ResponseStream(self, response)
+                try:
+                    result = parser(stream)
+                    stream.drain()
+                except (socket.error, HTTPException, zlib.error):
+                    self.discard(scheme, netloc)
+                    raise RetryableError("Failed reading %s" % url)
+                except:
+                    self.discard(scheme, netloc)
+                    raise
 
-            self.response_queue.put((data, context))
+                if response.will_close:
+                    self.discard(scheme, netloc)
+                return result
+            except RetryableError:
+                if attempt >= self.retries or not self.backoff(attempt, url):
+                    raise
+                attempt = attempt + 1
 
-            self.lock.acquire()
-            self.pending_count = self.pending_count - 1
-            self.lock.release()
+    def fetch(self, url):
+        return self.parse(url, lambda stream: stream.read())
 
-    def fetch(self, url, context = None):
-        self.lock.acquire()
-        self.pending_count = self.pending_count + 1
-        self.lock.release()
+client = None
 
-        self.fetch_queue.put((url, context))
+def get_client():
+    global client
+    if client is None:
+        client = HttpClient(connect_timeout = config_value("connecttimeout", CONNECT_TIMEOUT),
+                            read_timeout = config_value("readtimeout", READ_TIMEOUT),
+                            retries = config_value("retries", RETRIES),
+                            budget = config_value("retrybudget", RETRY_BUDGET))
+    return client
 
-    def next(self):
-        self.lock.acquire()
-        try:
-            if self.pending_count == 0 and self.response_queue.empty():
-                return (None, None)
-        finally:
-            self.lock.release()
+def http_fetch(url):
+    return get_client().fetch(url)
 
-        return self.response_queue.get(True)
+# Passes the response stream to parser rather than reading it into memory. Only
+# network errors are retried, errors from the parser are raised.
+def http_parse(url, parser, headers = None):
+    return get_client().parse(url, parser, headers)
 
+class FetchTask(object):
+    __slots__ = ("owner", "url", "host", "context", "id")
 
-class OrderedHttpQueue(object):
-    fetch_list = None
-    response_list = None
+    def __init__(self, owner, url, context, id):
+        self.owner = owner
+        self.url = url
+        self.host = urlsplit(url)[1]
+        self.context = context
+        self.id = id
+
+class FetchEngine(object):
     lock = None
-    next_response = None
-    next_fetch = None
+    threads = None
+    size = None
+    host_limit = None
+    waiting = None
+    hosts = None
+    closed = None
 
-    def __init__(self):
+    # A single pool of workers that makes the requests for every queue in the
+    # process. Requests are started in the order they were queued but no more
+    # than host_limit at once go to one host and a queue can limit how many of
+    # its own requests are in progress or waiting to be read. Workers are only
+    # started when there is work for them and exit on shutdown().
+    def __init__(self, threads = HTTP_THREADS, host_limit = HOST_CONNECTIONS):
         self.lock = Condition()
-        self.reset()
-
-        for i in range(HTTP_THREADS):
-             t = Thread(target = self.worker)
-             t.daemon = True
-             t.start()
-
-    def reset(self):
-        self.fetch_list = []
-        self.response_list = []
-        self.next_fetch = 0
-        self.next_response = 0
-
-    def get_next_fetch(self):
-        self.lock.acquire()
-        try:
-            while self.next_fetch >= len(self.fetch_list):
-                self.lock.wait()
-
-            id = self.next_fetch
-            (url, context) = self.fetch_list[id]
-            self.fetch_list[id] = None
-            self.next_fetch = self.next_fetch + 1
-            return (id, url, context)
-        finally:
-            self.lock.release()
+        self.threads = []
+        self.size = threads
+        self.host_limit = host_limit
+        self.waiting = deque()
+        self.hosts = dict()
+        self.closed = False
+
+    def submit(self, task):
+        with self.lock:
+            if self.closed:
+                raise Exception("The fetch engine has been shut down")
+            self.waiting.append(task)
+            if len(self.threads) < min(self.size, len(self.waiting)):
+                thread = Thread(target = self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.lock.notify()
+
+    # Drops every request from owner that has not yet started
+    def cancel(self, owner):
+        with self.lock:
+            self.waiting = deque(t for t in self.waiting if t.owner is not owner)
+            self.lock.notifyAll()
+
+    # Must be called with the lock held
+    def next_task(self):
+        blocked = set()
+        for task in self.waiting:
+            if task.host in blocked or task.owner in blocked:
+                continue
+            # Skipping a request also holds back the rest of its queue so
+            # requests always start in the order their queue asked for them
+            if self.hosts.get(task.host, 0) >= self.host_limit:
+                blocked.add(task.host)
+                blocked.add(task.owner)
+                continue
+            if not task.owner.can_start():
+                blocked.add(task.owner)
+                continue
+            self.waiting.remove(task)
+            return task
+        return None
 
     def worker(self):
         while True:
-            (id, url, context) = self.get_next_fetch()
+            with self.lock:
+                task = None
+                while not self.closed:
+                    task = self.next_task()
+                    if task is not None:
+                        break
+                    self.lock.wait()
+                if task is None:
+                    return
+                self.hosts[task.host] = self.hosts.get(task.host, 0) + 1
+                task.owner.started(task)
+
+            data = None
+            error = None
+            try:
+                if task.owner.parser:
+                    data = http_parse(task.url, task.owner.parser)
+                else:
+                    data = http_fetch(task.url)
+            except:
+                error = sys.exc_info()
 
-            data = http_fetch(url)
+            with self.lock:
+                self.hosts[task.host] = self.hosts[task.host] - 1
+                task.owner.finished(task, (data, task.context, error))
+                self.lock.notifyAll()
 
-            self.lock.acquire()
-            self.response_list[id] = (data, context)
+    # Stops the workers once their current requests are complete, requests
+    # that have not started are abandoned
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            self.waiting.clear()
             self.lock.notifyAll()
-            self.lock.release()
+            threads = self.threads
+            self.threads = []
+
+        for thread in threads:
+            thread.join()
+
+engine = None
+
+def get_engine():
+    global engine
+    if engine is None:
+        engine = FetchEngine(threads = config_value("fetchthreads", HTTP_THREADS),
+                             host_limit = config_value("hostconnections", HOST_CONNECTIONS))
+    return engine
+
+class BaseHttpQueue(object):
+    engine = None
+    lock = None
+    parser = None
+    concurrency = None
+    max_pending = None
+    queued = None
+    running = None
+    cancelled = None
+
+    # A queue's requests are made by the shared engine. No more than
+    # concurrency of them are in progress at once and no more than max_pending
+    # are in progress or held waiting for next() so a slow consumer doesn't
+    # fill memory with responses.
+    #
+    # If given parser is called with each response stream in the worker thread
+    # and its result is returned from next() in place of the raw data. Any
+    # exception raised by the parser or the request is re-raised from next().
+    def __init__(self, concurrency = HTTP_THREADS, parser = None, max_pending = PENDING_RESPONSES,
+                 engine = None):
+        self.engine = engine if engine is not None else get_engine()
+        self.lock = self.engine.lock
+        self.parser = parser
+        self.concurrency = concurrency
+        self.max_pending = max(1, max_pending)
+        self.queued = 0
+        self.running = 0
+        self.cancelled = False
 
     def fetch(self, url, context = None):
-        self.lock.acquire()
-        self.fetch_list.append((url, context))
-        self.response_list.append(None)
-        self.lock.notifyAll()
-        self.lock.release()
+        with self.lock:
+            task = FetchTask(self, url, context, self.queued)
+            self.queued = self.queued + 1
+        self.engine.submit(task)
+
+    # Called by the engine with the lock held
+    def can_start(self):
+        return self.running < self.concurrency and self.running + self.held() < self.max_pending
+
+    def started(self, task):
+        self.running = self.running + 1
+
+    def finished(self, task, result):
+        self.running = self.running - 1
+        if not self.cancelled:
+            self.store(task, result)
+
+    # Abandons every request that has not been returned by next()
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+        self.engine.cancel(self)
 
     def next(self):
-        self.lock.acquire()
-        try:
-            if self.next_response >= len(self.response_list):
-                self.reset()
-                return (None, None)
-
-            while True:
-                result = self.response_list[self.next_response]
-                if result:
-                    self.response_list[self.next_response] = None
-                    self.next_response = self.next_response + 1
-                    return result
-                self.lock.wait()
-        finally:
-            self.lock.release()
+        with self.lock:
+            result = self.take()
+            # Space was made for another request to start
+            self.lock.notifyAll()
+
+        if result is None:
+            return (None, None)
+
+        (data, context, error) = result
+        if error:
+            raise error[0], error[1], error[2]
+        return (data, context)
+
+class HttpQueue(BaseHttpQueue):
+    responses = None
+    returned = None
+
+    # Returns responses in the order they complete
+    def __init__(self, *args, **kwargs):
+        super(HttpQueue, self).__init__(*args, **kwargs)
+        self.responses = deque()
+        self.returned = 0
+
+    def held(self):
+        return len(self.responses)
+
+    def store(self, task, result):
+        self.responses.append(result)
+
+    def take(self):
+        while self.returned < self.queued and not self.cancelled:
+            if self.responses:
+                self.returned = self.returned + 1
+                return self.responses.popleft()
+            if self.engine.closed:
+                raise Exception("The fetch engine was shut down")
+            self.lock.wait()
+        return None
+
+class OrderedHttpQueue(BaseHttpQueue):
+    responses = None
+    returned = None
+
+    # Returns responses in the order they were requested
+    def __init__(self, *args, **kwargs):
+        super(OrderedHttpQueue, self).__init__(*args, **kwargs)
+        self.responses = dict()
+        self.returned = 0
+
+    def held(self):
+        return len(self.responses)
+
+    def store(self, task, result):
+        self.responses[task.id] = result
+
+    def take(self):
+        while self.returned < self.queued and not self.cancelled:
+            if self.returned in self.responses:
+                result = self.responses.pop(self.returned)
+                self.returned = self.returned + 1
+                return result
+            if self.engine.closed:
+                raise Exception("The fetch engine was shut down")
+            self.lock.wait()
+        return None
@@ -0,0 +1,200 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Sources that read pushes and patches from the local disk instead of hgweb,
+# either from a clone of the repository or from a directory of patches written
+# by hg export. They produce the same pushes as fetch_pushes and the same
+# (cset, patches) stream as prefetch_patches so add_pushes can index from them
+# unchanged. Anything a source doesn't have is fetched from hgweb.
+
+import calendar
+import os
+import sqlite3
+import subprocess
+
+from website.config import config_value
+from website.management.http import http_parse
+from website.management.patch import Patch, read_patch, split_patches, skip_hunks, newline_stripped
+from website.management.repo import fetch_pushes, decode_pushes, utc_datetime
+
+# The number of changesets exported by each hg process
+EXPORT_CHUNK = 500
+PUSHLOG_DB = os.path.join(".hg", "pushlog2.db")
+PUSHES_FILE = "pushes.json"
+
+def filter_pushes(pushes, start = None):
+    if not start:
+        return pushes
+    if 'id' in start:
+        return [p for p in pushes if p['id'] > start['id']]
+    if 'date' in start:
+        return [p for p in pushes if p['date'] >= start['date']]
+    if 'changeset' in start:
+        for push in pushes:
+            if start['changeset'] in push['changesets']:
+                return [p for p in pushes if p['id'] > push['id']]
+    return pushes
+
+def fetch_patch(ui, repository, cset, parent = None):
+    if parent is None:
+        url = "%sraw-rev/%s" % (repository.url, cset)
+    else:
+        url = "%sraw-rev/%s:%s" % (repository.url, parent, cset)
+    ui.log("fetching patch %s\n" % url)
+    return http_parse(url, read_patch)
+
+class HgCloneSource(object):
+    path = None
+
+    # Reads patches from a local clone with hg export, many changesets to each
+    # process. Pushes come from the clone's pushlog database when it has one.
+    def __init__(self, path):
+        self.path = path
+
+    def run(self, args):
+        env = dict(os.environ, HGPLAIN = "1")
+        return subprocess.Popen([config_value("hg", "hg"), "-R", self.path] + args, stdout = subprocess.PIPE, env = env)
+
+    def finish(self, process, args):
+        if process.poll() is None:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+        elif process.returncode != 0:
+            raise Exception("hg %s failed with %d" % (args[0], process.returncode))
+
+    def lines(self, args):
+        process = self.run(args)
+        try:
+            for line in process.stdout:
+                yield line
+            process.wait()
+        finally:
+            self.finish(process, args)
+
+    def pushes(self, ui, repository, start = None):
+        filename = os.path.join(self.path, PUSHLOG_DB)
+        if not os.path.exists(filename):
+            ui.info("no pushlog in %s, fetching pushes from %s\n" % (self.path, repository.url))
+            return fetch_pushes(ui, repository.url, start)
+
+        # Matches the pushes given by json-pushes
+        query = "SELECT id, user, date FROM pushlog"
+        params = []
+        if start and 'id' in start:
+            query = query + " WHERE id > ?"
+            params.append(start['id'])
+        elif start and 'date' in start:
+            query = query + " WHERE date >= ?"
+            params.append(calendar.timegm(start['date'].utctimetuple()))
+        elif start and 'changeset' in start:
+            query = query + " WHERE id > (SELECT pushid FROM changesets WHERE node = ?)"
+            params.append(start['changeset'])
+
+        db = sqlite3.connect(filename)
+        try:
+            pushes = [{ 'id': id, 'user': user, 'date': utc_datetime(date), 'changesets': [] }
+                      for (id, user, date) in db.execute(query + " ORDER BY id", params)]
+            if len(pushes) == 0:
+                return pushes
+
+            byid = dict((p['id'], p) for p in pushes)
+            for (pushid, node) in db.execute("SELECT pushid, node FROM changesets WHERE pushid >= ? "
+                                             "ORDER BY pushid, rev", [pushes[0]['id']]):
+                if pushid in byid:
+                    byid[pushid]['changesets'].append(str(node))
+        finally:
+            db.close()
+
+        ui.log("found %d pushes in %s\n" % (len(pushes), filename))
+        return pushes
+
+    def diff(self, parent, cset):
+        # A merge's diff against one of its other parents
+        lines = list(skip_hunks(newline_stripped(self.lines(["diff", "--git", "-r", parent, "-r", cset]))))
+        patch = Patch(lines + [""]) if len(lines) > 0 else Patch()
+        patch.hex = cset
+        return patch
+
+    def patches(self, ui, repository, csets):
+        csets = list(csets)
+        for i in range(0, len(csets), EXPORT_CHUNK):
+            chunk = csets[i:i + EXPORT_CHUNK]
+            args = ["export", "--git"]
+            for cset in chunk:
+                args.extend(["-r", cset])
+
+            ui.log("exporting %d changesets from %s\n" % (len(chunk), self.path))
+            # hg may not export them in the order asked for
+            exported = dict((p.hex, p) for p in split_patches(self.lines(args)))
+
+            for cset in chunk:
+                if cset not in exported:
+                    raise Exception("%s is missing from %s" % (cset, self.path))
+                patch = exported.pop(cset)
+                patches = [patch]
+                for parent in patch.parents[1:]:
+                    patches.append(self.diff(parent, cset))
+                yield (cset, patches)
+
+    def manifest(self, ui):
+        ui.log("reading manifest from %s\n" % self.path)
+        return self.lines(["manifest", "-r", "tip"])
+
+class PatchDirSource(object):
+    path = None
+    exported = None
+
+    # Reads patches from the files in a directory, each holding one or more
+    # patches written by hg export. Pushes come from a pushes.json file saved
+    # from json-pushes if there is one. Merges are only exported against their
+    # first parent so their other diffs are fetched from hgweb.
+    def __init__(self, path):
+        self.path = path
+
+    def pushes(self, ui, repository, start = None):
+        filename = os.path.join(self.path, PUSHES_FILE)
+        if not os.path.exists(filename):
+            ui.info("no %s in %s, fetching pushes from %s\n" % (PUSHES_FILE, self.path, repository.url))
+            return fetch_pushes(ui, repository.url, start)
+
+        with open(filename, "rb") as file:
+            pushes = decode_pushes(ui, file.read())
+        # A full pushlog lists changesets as objects
+        for push in pushes:
+            push['changesets'] = [c['node'] if isinstance(c, dict) else c for c in push['changesets']]
+        return filter_pushes(pushes, start)
+
+    def load(self, ui):
+        self.exported = dict()
+        for (path, dirs, files) in os.walk(self.path):
+            for name in sorted(files):
+                if path == self.path and name == PUSHES_FILE:
+                    continue
+                filename = os.path.join(path, name)
+                with open(filename, "rb") as file:
+                    for patch in split_patches(file):
+                        if patch.hex is not None:
+                            self.exported[patch.hex] = patch
+        ui.log("found %d patches in %s\n" % (len(self.exported), self.path))
+
+    def patches(self, ui, repository, csets):
+        if self.exported is None:
+            self.load(ui)
+
+        for cset in csets:
+            patch = self.exported.get(cset, None)
+            if patch is None:
+                patch = fetch_patch(ui, repository, cset)
+            patches = [patch]
+            for parent in patch.parents[1:]:
+                patches.append(fetch_patch(ui, repository, cset, parent))
+            yield (cset, patches)
+
+def open_source(path):
+    if os.path.isdir(os.path.join(path, ".hg")):
+        return HgCloneSource(path)
+    if os.path.isdir(path):
+        return PatchDirSource(path)
+    raise Exception("%s is neither a Mercurial clone nor a directory of patches" % path)
@@ -1,10 +1,159 @@
+import calendar
 from datetime import datetime
 from pytz import FixedOffset
 
+# The size of the blocks read from patch streams
+CHUNK_SIZE = 65536
+# The number of lines following each diff header that may describe the change
+HEADER_LINES = 3
+DIFF_HEADER = "diff --git "
+PATCH_HEADER = "# HG changeset patch"
+
 def newline_stripped(i):
     for l in i:
         yield l.rstrip("\r\n")
 
+class PatchReader(object):
+    stream = None
+    chunk_size = None
+    buffer = None
+    pos = None
+    eof = None
+    done = None
+
+    def __init__(self, stream, chunk_size = CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.done = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    # Returns the next line without its line ending, or None once the stream
+    # is exhausted. Like str.split the text after the final newline is always
+    # returned as a line, even when empty.
+    def readline(self):
+        if self.done:
+            return None
+
+        while True:
+            end = self.buffer.find("\n", self.pos)
+            if end >= 0:
+                line = self.buffer[self.pos:end]
+                self.pos = end + 1
+                return line.rstrip("\r")
+
+            if not self.fill():
+                line = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                self.done = True
+                return line.rstrip("\r")
+
+    # Discards everything up to the next line that starts with prefix without
+    # splitting the skipped text into lines. Must be called at the start of a
+    # line and returns False if the stream ended first.
+    def skip_to(self, prefix):
+        if self.done:
+            return False
+
+        while len(self.buffer) - self.pos < len(prefix) and self.fill():
+            pass
+        if self.buffer.startswith(prefix, self.pos):
+            return True
+
+        marker = "\n" + prefix
+        while True:
+            found = self.buffer.find(marker, self.pos)
+            if found >= 0:
+                self.pos = found + 1
+                return True
+
+            # Keep enough of the buffer to match a marker split across blocks
+            self.pos = max(self.pos, len(self.buffer) - len(marker) + 1)
+            if not self.fill():
+                self.pos = len(self.buffer)
+                self.done = True
+                return False
+
+def patch_lines(stream, chunk_size = CHUNK_SIZE):
+    # Yields the lines of a patch that Patch needs to see. The headers and
+    # description are returned in full but only the first few lines of each
+    # file's diff, the hunks are skipped over in blocks.
+    reader = PatchReader(stream, chunk_size)
+
+    line = reader.readline()
+    while line is not None and not line.startswith(DIFF_HEADER):
+        yield line
+        line = reader.readline()
+
+    while line is not None:
+        yield line
+
+        count = 0
+        line = reader.readline()
+        while line is not None and count < HEADER_LINES and not line.startswith(DIFF_HEADER):
+            yield line
+            count = count + 1
+            line = reader.readline()
+
+        if line is None or line.startswith(DIFF_HEADER):
+            continue
+
+        if not reader.skip_to(DIFF_HEADER):
+            return
+        line = reader.readline()
+
+def read_patch(stream, chunk_size = CHUNK_SIZE):
+    return Patch(patch_lines(stream, chunk_size))
+
+def skip_hunks(lines):
+    # The same as patch_lines for a patch that is already split into lines
+    count = None
+    for line in lines:
+        if line.startswith(DIFF_HEADER):
+            count = 0
+        elif line == PATCH_HEADER:
+            # The start of the next patch
+            count = None
+        elif count is None:
+            pass
+        elif count < HEADER_LINES:
+            count = count + 1
+        else:
+            continue
+        yield line
+
+def split_patches(lines):
+    # Yields a Patch for each of the patches in lines, as written by hg export
+    # for several changesets. Each patch is given the empty final line that
+    # splitting a single patch would give it.
+    patch = None
+    for line in skip_hunks(newline_stripped(lines)):
+        if line == PATCH_HEADER:
+            if patch is not None:
+                patch.append("")
+                yield Patch(patch)
+            patch = []
+        if patch is not None:
+            patch.append(line)
+
+    if patch is not None:
+        patch.append("")
+        yield Patch(patch)
+
 class Patch(object):
     hex = None
     user = None
@@ -17,13 +166,16 @@ class Patch(object):
     modified = None
     files = None
 
-    def __init__(self, lines):
+    def __init__(self, lines = None):
         self.parents = []
         self.removed = []
         self.added = []
         self.modified = []
         self.files = dict()
 
+        if lines is None:
+            return
+
         i = iter(newline_stripped(lines))
 
         try:
@@ -137,6 +289,37 @@ class Patch(object):
         except StopIteration:
             raise Exception("Patch file ended unexpectedly")
 
+    # Returns the parsed details as a plain dict suitable for caching
+    def to_dict(self):
+        return {
+            "hex": self.hex,
+            "user": self.user,
+            "date": calendar.timegm(self.date.utctimetuple()) if self.date else None,
+            "tzoffset": self.tzoffset,
+            "parents": self.parents,
+            "description": self.description,
+            "files": self.files,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        patch = cls()
+        patch.hex = data["hex"]
+        patch.user = data["user"]
+        patch.tzoffset = data["tzoffset"]
+        if data["date"] is not None:
+            patch.date = datetime.fromtimestamp(data["date"], FixedOffset(patch.tzoffset))
+        patch.parents = data["parents"]
+        patch.description = data["description"]
+        for (filename, type) in sorted(data["files"].items()):
+            if type == "A":
+                patch.mark_added(filename)
+            elif type == "R":
+                patch.mark_removed(filename)
+            else:
+                patch.mark_modified(filename)
+        return patch
+
     def mark_added(self, filename):
         self.files[filename] = "A"
         self.added.append(filename)
@@ -155,7 +338,7 @@ class Patch(object):
 if __name__ == "__main__":
     import sys
 
-    patch = Patch(sys.stdin)
+    patch = read_patch(sys.stdin)
     print("Changeset %s against parents %s" % (patch.hex, patch.parents))
     print("By %s at %s" % (patch.user, patch.date))
     print(patch.description)
@@ -0,0 +1,342 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+
+from django.db import connection, transaction
+
+from website.models import *
+
+# The rough number of paths to keep cached between flushes
+PATH_CACHE_SIZE = 100000
+
+# The interval of the root, every other interval lies inside it
+ROOT_INTERVAL = 2 ** 62
+# The space left free in a directory for each path beneath it
+INTERVAL_GAP = 1024
+# The extra space given to every directory when the intervals are rebuilt so
+# even empty directories have room for new ones
+DIR_SPARE = 65536
+# The number of paths renumbered by each query
+RENUMBER_CHUNK = 500
+
+def decode_path(path):
+    # Paths from patches and the pushlog are UTF-8 while those loaded from the
+    # database are unicode, everything cached or created uses unicode
+    if isinstance(path, str):
+        return path.decode("utf8", "replace")
+    return path
+
+def interval_width(is_dir, size, inner, spare = 0):
+    # A directory holds its children's intervals followed by free space in
+    # proportion to the number of paths beneath it
+    if not is_dir:
+        return 1
+    return 1 + inner + size * INTERVAL_GAP + spare
+
+def rebuild_intervals(ui = None):
+    # Renumbers every path in pre-order, giving each directory space for its
+    # children and for paths added later in proportion to its size. The
+    # caller is responsible for the transaction so the renumbering is never
+    # seen half done, the index lock keeps out writers until it ends.
+    lock_index()
+    children = dict()
+    is_dir = dict()
+    root = None
+    for (id, parent, dir) in Path.objects.order_by("name").values_list("id", "parent_id", "is_dir").iterator():
+        is_dir[id] = dir
+        if parent is None:
+            root = id
+        else:
+            children.setdefault(parent, []).append(id)
+
+    order = []
+    stack = [root]
+    while len(stack) > 0:
+        id = stack.pop()
+        order.append(id)
+        stack.extend(reversed(children.get(id, [])))
+
+    # Every path comes after everything beneath it in reverse pre-order
+    sizes = dict()
+    widths = dict()
+    for id in reversed(order):
+        below = children.get(id, [])
+        sizes[id] = 1 + sum(sizes[c] for c in below)
+        widths[id] = interval_width(is_dir[id], sizes[id], sum(widths[c] for c in below), DIR_SPARE)
+    if widths[root] > ROOT_INTERVAL:
+        raise Exception("%d paths need more space than the root interval has" % len(order))
+
+    intervals = { root: (0, ROOT_INTERVAL - 1) }
+    rows = []
+    for id in order:
+        (lft, rgt) = intervals[id]
+        free = lft + 1
+        for child in children.get(id, []):
+            intervals[child] = (free, free + widths[child] - 1)
+            free = free + widths[child]
+        rows.append((lft, rgt, free if is_dir[id] else None, id))
+
+    table = connection.ops.quote_name(Path._meta.db_table)
+    cursor = connection.cursor()
+    for i in range(0, len(rows), RENUMBER_CHUNK):
+        if ui is not None:
+            ui.progress("renumbering paths", i, len(rows))
+        cursor.executemany("UPDATE %s SET lft = %%s, rgt = %%s, free = %%s WHERE id = %%s" % table,
+                           rows[i:i + RENUMBER_CHUNK])
+    transaction.set_dirty()
+    if ui is not None:
+        ui.progress("renumbering paths")
+    return len(rows)
+
+class Directory(object):
+    children = None
+    linked = None
+
+    def __init__(self, children = None, linked = None):
+        self.children = children if children is not None else dict()
+        self.linked = linked if linked is not None else set()
+
+class PathResolver(object):
+    repository = None
+    root = None
+    root_linked = None
+    size = None
+    directories = None
+    count = None
+    new_paths = None
+    new_ids = None
+    new_ancestors = None
+    new_links = None
+
+    # Resolves slash separated paths to Path objects for a repository, creating
+    # any that are missing. The children of each directory are loaded from the
+    # database a level at a time and cached, keyed by the parent's id and then
+    # name, with the least recently used directories evicted once the cache
+    # holds more than size paths. New paths, their ancestors and any missing
+    # links to the repository are only written by flush(), which also gives
+    # the new paths their intervals.
+    def __init__(self, repository, size = PATH_CACHE_SIZE):
+        self.repository = repository
+        self.size = size
+        self.directories = OrderedDict()
+        self.count = 0
+        self.new_paths = []
+        self.new_ids = set()
+        self.new_ancestors = []
+        self.new_links = []
+
+        self.root = repository.root
+        links = Path.repositories.through.objects.filter(repository = repository, path = self.root)
+        self.root_linked = links.exists()
+
+    def directory(self, path):
+        if path.id in self.directories:
+            directory = self.directories.pop(path.id)
+            self.directories[path.id] = directory
+            return directory
+
+        if path.id in self.new_ids:
+            directory = Directory()
+        else:
+            children = dict((p.name, p) for p in Path.objects.filter(parent = path))
+            links = Path.repositories.through.objects.filter(repository = self.repository, path__parent = path)
+            linked = set(links.values_list("path_id", flat = True))
+            directory = Directory(children, linked)
+
+        self.directories[path.id] = directory
+        self.count = self.count + len(directory.children)
+        return directory
+
+    def create_path(self, parents, name, is_dir):
+        fullpath = join_path(parents[-1].path, name)
+        path = Path(id = Path.next_id(), name = name, parent = parents[-1], is_dir = is_dir,
+                    path = fullpath, path_hash = path_hash(fullpath), depth = len(parents))
+        self.new_paths.append(path)
+        self.new_ids.add(path.id)
+
+        depth = len(parents)
+        for ancestor in parents:
+            self.new_ancestors.append(Ancestor(path = path, ancestor = ancestor, depth = depth))
+            depth = depth - 1
+        self.new_ancestors.append(Ancestor(path = path, ancestor = path, depth = 0))
+
+        return path
+
+    # Returns the Path for path if it is part of the repository's tree, without
+    # creating anything.
+    def linked_path(self, path):
+        parent = self.root
+        for name in decode_path(path).split("/"):
+            directory = self.directory(parent)
+            if name not in directory.children or directory.children[name].id not in directory.linked:
+                return None
+            parent = directory.children[name]
+        return parent
+
+    def get_path(self, path, is_dir = False):
+        if not self.root_linked:
+            self.new_links.append(self.root.id)
+            self.root_linked = True
+
+        names = decode_path(path).split("/")
+        parents = [self.root]
+        for (pos, name) in enumerate(names):
+            directory = self.directory(parents[-1])
+
+            if name in directory.children:
+                child = directory.children[name]
+            else:
+                child_is_dir = is_dir if pos == len(names) - 1 else True
+                child = self.create_path(parents, name, child_is_dir)
+                directory.children[name] = child
+                self.count = self.count + 1
+
+            if child.id not in directory.linked:
+                self.new_links.append(child.id)
+                directory.linked.add(child.id)
+
+            parents.append(child)
+
+        return parents[-1]
+
+    # The number of rows waiting to be written
+    def staged(self):
+        return len(self.new_paths) + len(self.new_ancestors) + len(self.new_links)
+
+    # Gives each new path an interval from the free space of its parent,
+    # returning False if a directory has run out of space. New directories are
+    # sized for what is being added beneath them with up to half of the space
+    # left in the existing directory above them spread between them as spare,
+    # so later batches can add to them too. The caller holds the index lock so
+    # the free space of existing directories is read and reserved in a query
+    # each.
+    def allocate_intervals(self):
+        children = OrderedDict()
+        for path in self.new_paths:
+            children.setdefault(path.parent_id, []).append(path)
+
+        # Parents are always created before their children. Spare space adds
+        # the same amount to the width of every directory beneath a path.
+        sizes = dict()
+        widths = dict()
+        dirs = dict()
+        for path in reversed(self.new_paths):
+            below = children.get(path.id, [])
+            sizes[path.id] = 1 + sum(sizes[c.id] for c in below)
+            widths[path.id] = interval_width(path.is_dir, sizes[path.id], sum(widths[c.id] for c in below))
+            dirs[path.id] = (1 if path.is_dir else 0) + sum(dirs[c.id] for c in below)
+
+        parents = [id for id in children.iterkeys() if id not in self.new_ids]
+        space = dict()
+        for i in range(0, len(parents), PATH_CHUNK):
+            found = Path.objects.select_for_update().filter(id__in = parents[i:i + PATH_CHUNK])
+            space.update((id, (free, rgt)) for (id, free, rgt) in found.values_list("id", "free", "rgt"))
+
+        spares = dict()
+        reserved = []
+        for (parent_id, paths) in children.iteritems():
+            parent = paths[0].parent
+            if parent_id in self.new_ids:
+                free = parent.free
+            else:
+                (free, rgt) = space[parent_id]
+            # The intervals have never been built, new paths beneath are left
+            # without them too
+            if free is None:
+                continue
+
+            if parent_id in self.new_ids:
+                spare = spares[parent_id]
+            else:
+                needed = sum(widths[p.id] for p in paths)
+                if free + needed > rgt + 1:
+                    return False
+                count = sum(dirs[p.id] for p in paths)
+                spare = min(DIR_SPARE, (rgt + 1 - free - needed) / (2 * count)) if count > 0 else 0
+                reserved.append((parent_id, free + needed + count * spare))
+
+            for path in paths:
+                spares[path.id] = spare
+                path.lft = free
+                path.rgt = free + widths[path.id] + dirs[path.id] * spare - 1
+                path.free = free + 1 if path.is_dir else None
+                free = path.rgt + 1
+            parent.free = free
+
+        table = connection.ops.quote_name(Path._meta.db_table)
+        cursor = connection.cursor()
+        for i in range(0, len(reserved), PATH_CHUNK):
+            chunk = reserved[i:i + PATH_CHUNK]
+            cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute("UPDATE %s SET free = CASE id %s END WHERE id IN (%s)" % (table, cases, placeholders),
+                           [v for row in chunk for v in row] + [id for (id, free) in chunk])
+        transaction.set_dirty()
+
+        return True
+
+    # Another process may have created some of the same paths since they were
+    # looked up. Once the index is locked those are found and used in place of
+    # the staged ones, with everything staged that refers to them updated.
+    def adopt_existing(self):
+        byhash = dict((p.path_hash, p) for p in self.new_paths)
+        hashes = byhash.keys()
+        existing = []
+        for i in range(0, len(hashes), PATH_CHUNK):
+            paths = Path.objects.select_for_update().filter(path_hash__in = hashes[i:i + PATH_CHUNK])
+            existing.extend(paths.values_list("path_hash", "id", "lft", "rgt", "free"))
+        if len(existing) == 0:
+            return
+
+        ids = dict()
+        for (hash, id, lft, rgt, free) in existing:
+            path = byhash[hash]
+            ids[path.id] = id
+            self.new_ids.discard(path.id)
+            # The directory's cached children are only those staged here
+            directory = self.directories.pop(path.id, None)
+            if directory is not None:
+                self.count = self.count - len(directory.children)
+            (path.id, path.lft, path.rgt, path.free) = (id, lft, rgt, free)
+
+        adopted = set(ids.itervalues())
+        self.new_paths = [p for p in self.new_paths if p.id not in adopted]
+        for path in self.new_paths:
+            path.parent_id = ids.get(path.parent_id, path.parent_id)
+        self.new_ancestors = [a for a in self.new_ancestors if a.path_id not in ids]
+        for ancestor in self.new_ancestors:
+            ancestor.ancestor_id = ids.get(ancestor.ancestor_id, ancestor.ancestor_id)
+        self.new_links = [ids.get(id, id) for id in self.new_links]
+
+    # Writes everything staged, returning the number of new paths
+    def flush(self):
+        lock_index()
+        self.adopt_existing()
+        added = len(self.new_paths)
+        renumber = not self.allocate_intervals()
+        if renumber:
+            for path in self.new_paths:
+                path.lft = path.rgt = path.free = None
+        Path.objects.bulk_create(self.new_paths)
+        Ancestor.objects.bulk_create(self.new_ancestors)
+
+        through = Path.repositories.through
+        through.objects.bulk_create([through(path_id = id, repository_id = self.repository.id) for id in self.new_links])
+
+        if renumber:
+            rebuild_intervals()
+
+        self.new_paths = []
+        self.new_ids = set()
+        self.new_ancestors = []
+        self.new_links = []
+
+        # Directories are only evicted once everything in them has been written
+        # so that reloading them from the database never misses a path
+        while self.count > self.size and len(self.directories) > 0:
+            (id, directory) = self.directories.popitem(last = False)
+            self.count = self.count - len(directory.children)
+
+        return added
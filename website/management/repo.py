@@ -4,28 +4,148 @@
 
 import json
 import re
+from collections import deque
+from itertools import islice
 from datetime import datetime, timedelta
 from urllib import urlencode
 
-from pytz import timezone, utc
+from pytz import timezone, utc, FixedOffset
 
 from django.db.models import Max
 from django.db import transaction
 
-from base.utils import config
-
+from website.config import config_value
 from website.models import *
-from website.management.http import http_fetch
-from website.management.patch import Patch
+from website.locks import FileLock
+from website.shared import TYPEMAP
+from website.management.http import http_fetch, http_parse, get_client, OrderedHttpQueue, HttpError, RetryableError, HTTP_THREADS
+from website.management.patch import read_patch
+from website.management.paths import PathResolver, PATH_CACHE_SIZE
+from website.management.writer import IndexWriter
+from website.management.cache import PatchCache
+
+# The number of patches that may be fetched ahead of the database writer
+FETCH_WINDOW = 200
+# The number of pushes written to the database in each transaction
+WRITE_BATCH = 20
+# The number of new changesets after which a transaction is committed even
+# part way through a push
+WRITE_CHANGESETS = 200
+# The number of pushes or changesets deleted at a time when expiring
+EXPIRE_CHUNK = 500
+# The minimum number of seconds between expiring old pushes
+EXPIRE_INTERVAL = 3600
+
+NULL_HEX = "0" * 40
 
 def utc_datetime(timestamp):
     return datetime.fromtimestamp(timestamp, utc)
 
-def fetch_pushes(ui, url, start = None):
+def pushlog_files(data):
+    return [entry["file"] if isinstance(entry, dict) else entry for entry in data.get("files", [])]
+
+def pushlog_changeset(data, resolver, touched, tree_current):
+    # Attempts to build the changeset fields and file changes from the full
+    # pushlog data for a changeset. Plain pushlog file lists don't say how each
+    # file changed so only files that are new to the repository's tree can be
+    # marked as added, anything else needs the diff. Returns None if the diff
+    # is needed. touched holds every file seen so far in this run. Until the
+    # first update has finished the tree only holds the files of the tip that
+    # initrepo loaded, so files missing from it may have been removed since
+    # and tree_current is False.
+    files = data.get("files")
+    if files is None:
+        return None
+
+    names = []
+    types = dict()
+    determined = True
+    for entry in files:
+        if isinstance(entry, dict):
+            name = entry["file"]
+            status = entry.get("status")
+        else:
+            name = entry
+            status = None
+        names.append(name)
+
+        if status in TYPEMAP:
+            types[name] = TYPEMAP[status]
+        elif tree_current and name not in touched and resolver.linked_path(name) is None:
+            types[name] = "A"
+        else:
+            determined = False
+
+    touched.update(names)
+
+    parents = [p for p in data.get("parents", []) if p != NULL_HEX]
+    if not determined or len(parents) > 1 or "date" not in data:
+        return None
+
+    (timestamp, offset) = data["date"]
+    tzoffset = -int(offset) / 60
+    date = datetime.fromtimestamp(int(timestamp), FixedOffset(tzoffset))
+
+    return (data["node"], data["author"], date, tzoffset, data["desc"], parents, types)
+
+def prefetch_patches(ui, repository, csets, cache):
+    # Fetches and parses the patches for the given changesets concurrently,
+    # yielding (cset, patches) in the order given. No more than the window
+    # size of patches are held in memory at once. Patches found in the cache
+    # are not downloaded and newly downloaded ones are added to it.
+    threads = config_value("fetchthreads", HTTP_THREADS)
+    window = config_value("fetchwindow", FETCH_WINDOW)
+    queue = OrderedHttpQueue(concurrency = threads, parser = read_patch, max_pending = window)
+
+    pending = iter(csets)
+    # Each entry is the changeset and its cached patch or None if fetching
+    order = deque()
+
+    def queue_fetches(count):
+        for cset in islice(pending, count):
+            patch = cache.load(cset)
+            if patch is None:
+                url = "%sraw-rev/%s" % (repository.url, cset)
+                ui.log("fetching patch %s\n" % url)
+                queue.fetch(url, cset)
+            else:
+                ui.log("using cached patch for %s\n" % cset)
+            order.append((cset, patch))
+
+    queue_fetches(window)
+    try:
+        while len(order) > 0:
+            (cset, patch) = order.popleft()
+            queue_fetches(1)
+
+            if patch is None:
+                (patch, fetched) = queue.next()
+                cache.store(patch)
+
+            patches = [patch]
+            # Merges need a diff against each additional parent which can only be
+            # known once the first patch has been seen
+            for parent in patch.parents[1:]:
+                merge = cache.load(cset, parent)
+                if merge is None:
+                    url = "%sraw-rev/%s:%s" % (repository.url, parent, cset)
+                    ui.log("fetching patch %s\n" % url)
+                    merge = http_parse(url, read_patch)
+                    cache.store(merge, parent)
+                patches.append(merge)
+
+            yield (cset, patches)
+    finally:
+        # Nothing more is needed if the caller stopped early
+        queue.cancel()
+
+def pushes_url(url, start = None, full = False):
     url = "%sjson-pushes" % url
 
+    query = dict()
+    if full:
+        query['full'] = 1
     if start:
-        query = dict()
         if 'date' in start:
             date = start['date'].astimezone(timezone('America/Los_Angeles'))
             query['startdate'] = date.strftime("%Y-%m-%d %H:%M:%S")
@@ -33,49 +153,43 @@ def fetch_pushes(ui, url, start = None):
             query['fromchange'] = start['changeset']
         elif 'id' in start:
             query['startID'] = start['id']
+    if query:
         url = url + '?' + urlencode(query)
+    return url
 
-    ui.log("fetching pushes: %s\n" % url)
-    results = json.loads(http_fetch(url))
+def decode_pushes(ui, data, full = False):
+    results = json.loads(data)
+    # Newer pushlogs may nest the pushes
+    if 'pushes' in results:
+        results = results['pushes']
     ids = [int(k) for k in results.keys()]
     ids.sort()
     pushes = [dict(results[str(id)], id = id, date = utc_datetime(results[str(id)]['date'])) for id in ids]
+
+    if full:
+        # Keep the changesets as a list of hexes and the full data to the side
+        for push in pushes:
+            push['changesetdata'] = dict((c['node'], c) for c in push['changesets'])
+            push['changesets'] = [c['node'] for c in push['changesets']]
     ui.log("found %d pushes\n" % len(pushes))
     return pushes
 
-def get_path(repository, path, is_dir = False):
-    names = path.split("/")
-    paths = [repository.root]
-    while len(names) > 0:
-        try:
-            paths.append(Path.objects.get(parent = paths[-1], name = names[0]))
-            names = names[1:]
-        except Path.DoesNotExist:
-            break
-
-    if len(names):
-        newpaths = []
-        ancestors = []
-        while len(names) > 0:
-            is_dir = is_dir if len(names) == 1 else True
-            path = Path(id = Path.next_id(), name = names[0], parent = paths[-1], is_dir = is_dir)
-            names = names[1:]
-            newpaths.append(path)
-
-            depth = len(paths)
-            for ancestor in paths:
-                ancestors.append(Ancestor(path = path, ancestor = ancestor, depth = depth))
-                depth = depth - 1
-            ancestors.append(Ancestor(path = path, ancestor = path, depth = 0))
-
-            paths.append(path)
-
-        Path.objects.bulk_create(newpaths)
-        Ancestor.objects.bulk_create(ancestors)
-
-    repository.paths.add(*paths)
-
-    return paths[-1]
+def fetch_pushes(ui, url, start = None, full = False):
+    url = pushes_url(url, start, full)
+    ui.log("fetching pushes: %s\n" % url)
+    return decode_pushes(ui, http_fetch(url), full)
+
+def poll_pushes(ui, url, start = None, full = False, etag = None):
+    # Like fetch_pushes but returns (pushes, etag). If etag is given and the
+    # server says nothing has changed since then pushes is None.
+    url = pushes_url(url, start, full)
+    ui.log("polling pushes: %s\n" % url)
+    headers = { "If-None-Match": etag } if etag else None
+    result = http_parse(url, lambda stream: (stream.read(), stream.getheader("etag")), headers)
+    if result is None:
+        return (None, etag)
+    (data, etag) = result
+    return (decode_pushes(ui, data, full), etag)
 
 def merge_changes(a, b):
     # If both sides have the same change then the merge introduced it
@@ -87,45 +201,114 @@ def merge_changes(a, b):
     # If the changes differ then a modification has been made in the merge
     return "M"
 
+def save_checkpoint(repository, push_id, index):
+    # A new push id means the pushlog is polled from a new URL so the old
+    # validator no longer applies
+    if not Checkpoint.objects.filter(repository = repository).update(push_id = push_id, index = index, etag = ""):
+        Checkpoint(repository = repository, push_id = push_id, index = index).save()
+
 @transaction.commit_manually()
-def add_pushes(ui, repository, pushes):
+def add_pushes(ui, repository, pushes, checkpoint = None, source = None):
+    # Pushes are written in short transactions, each recording how far
+    # indexing has got. If checkpoint shows that the first push was only partly
+    # written then indexing continues from where it stopped. Patches are read
+    # from source if given rather than fetched from hgweb. Without a checkpoint
+    # this is the first update so file changes aren't inferred from the tree.
+    # Returns False if indexing failed and the last transaction was rolled back.
     if len(pushes) == 0:
         ui.status("no new changesets to index\n")
-        return
+        return True
+
+    resume = None
+    if checkpoint is not None and checkpoint.index is not None and pushes[0]['id'] == checkpoint.push_id:
+        resume = checkpoint.index
 
     changeset_count = reduce(lambda s, p: s + len(p['changesets']), pushes, 0)
     complete = 0
     added = 0
     ui.progress("indexing changesets", complete, changeset_count)
 
-    ignore = []
-    if config.has_option("hgchangefeed", "ignore"):
-        ignore = config.get("hgchangefeed", "ignore").split(",")
+    ignore = config_value("ignore", "")
+    ignore = ignore.split(",") if ignore else []
 
+    cache = None
     try:
+        csets = []
         for pushdata in pushes:
-            push = Push(push_id = pushdata['id'], repository = repository, user = pushdata['user'], date = pushdata['date'])
-            push.save()
+            csets.extend([c for c in pushdata['changesets'] if c[0:12] not in ignore])
+
+        resolver = PathResolver(repository, config_value("pathcache", PATH_CACHE_SIZE))
+        writer = IndexWriter(repository, resolver, set(csets))
+        cache = PatchCache()
 
-            changes = []
-            index = 0
+        # Changesets that can be indexed from the pushlog data alone
+        from_pushlog = dict()
+        touched = set()
+        needed = []
+        seen = set()
+        for pushdata in pushes:
             for cset in pushdata['changesets']:
+                if cset[0:12] in ignore or cset in seen:
+                    continue
+                seen.add(cset)
+
+                # Changesets already indexed, perhaps for another repository,
+                # still add their files to this repository's tree
+                if writer.has_changeset(cset):
+                    if 'changesetdata' in pushdata:
+                        touched.update(pushlog_files(pushdata['changesetdata'][cset]))
+                    continue
+
+                if 'changesetdata' in pushdata:
+                    changeset = pushlog_changeset(pushdata['changesetdata'][cset], resolver, touched,
+                                                  checkpoint is not None)
+                    if changeset is not None:
+                        from_pushlog[cset] = changeset
+                        continue
+
+                needed.append(cset)
+
+        if from_pushlog:
+            ui.info("indexing %d changesets from the pushlog\n" % len(from_pushlog))
+        if source is None:
+            fetched = prefetch_patches(ui, repository, needed, cache)
+        else:
+            fetched = source.patches(ui, repository, needed)
+
+        def commit(push_id, position):
+            writer.flush()
+            save_checkpoint(repository, push_id, position)
+            transaction.commit()
+
+        batch = config_value("writebatch", WRITE_BATCH)
+        batch_changesets = config_value("writechangesets", WRITE_CHANGESETS)
+        staged = 0
+        for pushdata in pushes:
+            first = 0
+            if resume is not None and pushdata['id'] == checkpoint.push_id:
+                ui.info("resuming push %d at changeset %d\n" % (checkpoint.push_id, resume))
+                index = writer.resume_push(pushdata['id'])
+                first = resume
+                complete = complete + first
+                resume = None
+            else:
+                writer.add_push(pushdata['id'], pushdata['user'], pushdata['date'])
+                index = 0
+
+            for (position, cset) in islice(enumerate(pushdata['changesets']), first, None):
                 if cset[0:12] in ignore:
                     ui.warn("Ignoring changeset %s" % cset)
                     continue
                 try:
-                    try:
-                        changeset = Changeset.objects.get(hex = cset)
-                    except Changeset.DoesNotExist:
+                    if cset in from_pushlog:
+                        ui.log("indexing changeset %s from the pushlog\n" % cset)
+                        writer.add_changeset(*from_pushlog.pop(cset))
+                        added = added + 1
+                    elif not writer.has_changeset(cset):
                         ui.log("indexing changeset %s\n" % cset)
-                        url = "%sraw-rev/%s" % (repository.url, cset)
-                        ui.log("fetching patch %s\n"% url)
-                        patches = [Patch(http_fetch(url).split("\n"))]
-
-                        for parent in patches[0].parents[1:]:
-                            url = "%sraw-rev/%s:%s" % (repository.url, parent, cset)
-                            ui.log("fetching patch %s\n"% url)
-                            patches.append(Patch(http_fetch(url).split("\n")))
+                        (patchcset, patches) = fetched.next()
+                        if patchcset != cset:
+                            raise Exception("Received patch for %s, expecting %s" % (patchcset, cset))
 
                         allfiles = set()
 
@@ -134,32 +317,21 @@ def add_pushes(ui, repository, pushes):
                                 raise Exception("Saw unexpected changeset %s, expecting %s" % (patch.hex, cset))
                             allfiles.update(patch.files.keys())
 
-                        ui.log("indexing changeset %s complete\n" % cset)
-                        changeset = Changeset(hex = patches[0].hex,
-                                              author = patches[0].user,
-                                              date = patches[0].date,
-                                              tzoffset = patches[0].tzoffset,
-                                              description = patches[0].description)
-                        changeset.save()
-                        added = added + 1
-
-                        for parent in patches[0].parents:
-                            cp = ChangesetParent(changeset = changeset, parenthex = parent)
-                            cp.save()
-
+                        files = dict()
                         for file in allfiles:
                             changetypes = [p.files.get(file, None) for p in patches]
                             changetype = reduce(merge_changes, changetypes)
 
-                            if changetype is None:
-                                continue
+                            if changetype is not None:
+                                files[file] = changetype
 
-                            path = get_path(repository, file)
-                            change = Change(id = Change.next_id(), changeset = changeset, path = path, type = changetype)
-                            changes.append(change)
+                        ui.log("indexing changeset %s complete\n" % cset)
+                        writer.add_changeset(patches[0].hex, patches[0].user, patches[0].date,
+                                             patches[0].tzoffset, patches[0].description,
+                                             patches[0].parents, files)
+                        added = added + 1
 
-                    pc = PushChangeset(push = push, changeset = changeset, index = index)
-                    pc.save()
+                    writer.add_push_changeset(pushdata['id'], cset, index)
                     index = index + 1
 
                     complete = complete + 1
@@ -169,34 +341,145 @@ def add_pushes(ui, repository, pushes):
                     ui.warn("failed indexing changeset %s\n" % cset)
                     raise
 
-            Change.objects.bulk_create(changes)
-            transaction.commit()
+                if writer.staged_changesets() >= batch_changesets:
+                    commit(pushdata['id'], position + 1)
+                    staged = 0
+
+            staged = staged + 1
+            if staged >= batch:
+                commit(pushdata['id'], None)
+                staged = 0
+
+        commit(pushes[-1]['id'], None)
+        return True
     except:
         ui.traceback()
         transaction.rollback()
+        return False
     finally:
         ui.progress("indexing changesets")
         ui.status("added %d changesets\n" % added)
+        if cache is not None:
+            cache.maybe_prune()
 
 def expire_changesets(ui, repository):
+    # Expires pushes a chunk at a time, only considering changesets that were
+    # part of the expired pushes for deletion. Each chunk is its own transaction
+    # so the work done is bounded by what is being expired.
     oldest = datetime.now(utc) - timedelta(seconds = repository.range)
 
     pushes = Push.objects.filter(repository = repository, date__lt = oldest)
-    ui.status("deleting %d pushes\n" % len(pushes))
-    pushes.delete()
-
-    changesets = Changeset.objects.filter(pushes__isnull = True)
-    ui.status("deleting %d changesets\n" % len(changesets))
-    changesets.delete()
-
-def update_repository(ui, repository):
-    start = dict()
-    last_push = Push.objects.filter(repository = repository).aggregate(Max("push_id"))["push_id__max"]
-    if last_push:
-        start['id'] = last_push
-    else:
-        start['date'] = datetime.now(utc) - timedelta(seconds = repository.range)
-
-    pushes = fetch_pushes(ui, repository.url, start)
-    add_pushes(ui, repository, pushes)
-    expire_changesets(ui, repository)
+    push_count = pushes.count()
+    ui.status("deleting %d pushes\n" % push_count)
+    if push_count == 0:
+        return
+
+    deleted = 0
+    complete = 0
+    while True:
+        expired = list(pushes.order_by("push_id").values_list("id", "push_id")[:EXPIRE_CHUNK])
+        if len(expired) == 0:
+            break
+        push_ids = [id for (id, push_id) in expired]
+        ui.progress("expiring pushes", complete, push_count)
+
+        with transaction.commit_on_success():
+            pushchangesets = PushChangeset.objects.filter(push__in = push_ids)
+            candidates = set(pushchangesets.values_list("changeset_id", flat = True))
+            pushchangesets.delete()
+            PathChangeset.objects.filter(repository = repository,
+                                         push_id__in = [push_id for (id, push_id) in expired]).delete()
+            Push.objects.filter(id__in = push_ids).delete()
+
+        candidates = list(candidates)
+        for i in range(0, len(candidates), EXPIRE_CHUNK):
+            chunk = candidates[i:i + EXPIRE_CHUNK]
+            with transaction.commit_on_success():
+                remaining = set(PushChangeset.objects.filter(changeset__in = chunk).values_list("changeset_id", flat = True))
+                orphans = [id for id in chunk if id not in remaining]
+                if len(orphans) == 0:
+                    continue
+
+                PathChangeset.objects.filter(changeset__in = orphans).delete()
+                Change.objects.filter(changeset__in = orphans).delete()
+                ChangesetParent.objects.filter(changeset__in = orphans).delete()
+                Changeset.objects.filter(id__in = orphans).delete()
+                deleted = deleted + len(orphans)
+
+        complete = complete + len(push_ids)
+
+    ui.progress("expiring pushes")
+    ui.status("deleted %d changesets\n" % deleted)
+
+def expiry_due(checkpoint):
+    if checkpoint is None or checkpoint.expired is None:
+        return True
+    interval = timedelta(seconds = config_value("expireinterval", EXPIRE_INTERVAL))
+    return datetime.now(utc) - checkpoint.expired >= interval
+
+def update_repository(ui, repository, source = None):
+    # Returns the number of new pushes found or None if the repository could
+    # not be updated. Polling a repository with nothing new costs a single
+    # conditional request and a single query unless expiry is due. If given
+    # pushes and patches are read from the local source instead.
+    lock = FileLock("repository-%d" % repository.id)
+    if not lock.acquire(blocking = False):
+        ui.warn("%s is already being updated\n" % repository.name)
+        return None
+
+    client = get_client()
+    client.reset_stats()
+
+    try:
+        start = dict()
+        etag = None
+        try:
+            checkpoint = Checkpoint.objects.get(repository = repository)
+            etag = checkpoint.etag or None
+            # startID is exclusive so include a partly written push
+            if checkpoint.index is None:
+                start['id'] = checkpoint.push_id
+            else:
+                start['id'] = checkpoint.push_id - 1
+        except Checkpoint.DoesNotExist:
+            checkpoint = None
+            last_push = Push.objects.filter(repository = repository).aggregate(Max("push_id"))["push_id__max"]
+            if last_push:
+                start['id'] = last_push
+                # Saves looking for the last push again next time
+                save_checkpoint(repository, last_push, None)
+                checkpoint = Checkpoint.objects.get(repository = repository)
+            else:
+                start['date'] = datetime.now(utc) - timedelta(seconds = repository.range)
+
+        if source is None:
+            full = config_value("ingest", "diff") == "pushlog"
+            try:
+                (pushes, etag) = poll_pushes(ui, repository.url, start, full, etag)
+            except (HttpError, RetryableError):
+                # Leaves other repositories to be updated
+                ui.traceback()
+                return None
+        else:
+            pushes = source.pushes(ui, repository, start)
+
+        count = 0
+        if pushes:
+            if not add_pushes(ui, repository, pushes, checkpoint, source):
+                return None
+            count = len(pushes)
+        else:
+            ui.status("no new pushes\n")
+            # The same URL will be polled next time
+            if checkpoint is not None and (etag or "") != checkpoint.etag:
+                Checkpoint.objects.filter(repository = repository).update(etag = etag or "")
+
+        if expiry_due(checkpoint):
+            expire_changesets(ui, repository)
+            Checkpoint.objects.filter(repository = repository).update(expired = datetime.now(utc))
+
+        return count
+    finally:
+        lock.release()
+        ui.info("made %d requests, received %d bytes, retried %d times\n" %
+                (client.requests, client.bytes, client.retried))
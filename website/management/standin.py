@@ -0,0 +1,366 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A local stand-in for hgweb that serves json-pushes, raw-rev and raw
+# directory listings from a corpus on disk so indexing can be run and measured
+# without a live server. A corpus is a directory holding:
+#
+#   pushes.json   the full pushlog as returned by json-pushes?full=1
+#   raw-rev/      a file for each patch named as in the raw-rev URL, either
+#                 the changeset or parent:changeset for merges
+#   manifest      the repository's files, one per line
+#
+# A corpus can be recorded from a real server or generated.
+
+import hashlib
+import json
+import os
+import random
+import socket
+import time
+# strptime imports this lazily, which can fail in handler threads
+import _strptime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+from threading import Thread
+from urlparse import urlsplit, parse_qs
+from urllib import unquote
+
+from pytz import timezone, utc
+
+from website.management.http import http_fetch, HttpQueue
+from website.management.repo import fetch_pushes, NULL_HEX
+
+PUSHES_FILE = "pushes.json"
+MANIFEST_FILE = "manifest"
+PATCH_DIR = "raw-rev"
+# The number of pushes json-pushes returns when not asked for a range
+DEFAULT_PUSHES = 10
+
+class Corpus(object):
+    directory = None
+    pushes = None
+    tree = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, PUSHES_FILE), "rb") as file:
+            self.pushes = sorted((int(id), data) for (id, data) in json.load(file).items())
+
+        # Maps each directory to its subdirectories and files
+        self.tree = { "": (set(), dict()) }
+        with open(os.path.join(directory, MANIFEST_FILE), "rb") as file:
+            for line in file:
+                path = line.rstrip("\r\n")
+                if len(path) == 0:
+                    continue
+                parts = path.split("/")
+                parent = ""
+                for part in parts[:-1]:
+                    child = part if parent == "" else "%s/%s" % (parent, part)
+                    self.tree[parent][0].add(part)
+                    self.tree.setdefault(child, (set(), dict()))
+                    parent = child
+                self.tree[parent][1][parts[-1]] = len(path)
+
+    def changeset_count(self):
+        return sum(len(data["changesets"]) for (id, data) in self.pushes)
+
+    def oldest(self):
+        return min(datetime.fromtimestamp(data["date"], utc) for (id, data) in self.pushes)
+
+    def select_pushes(self, query):
+        pushes = self.pushes
+        if "startID" in query:
+            start = int(query["startID"][0])
+            pushes = [(id, data) for (id, data) in pushes if id > start]
+        elif "startdate" in query:
+            date = datetime.strptime(query["startdate"][0], "%Y-%m-%d %H:%M:%S")
+            date = timezone("America/Los_Angeles").localize(date).astimezone(utc)
+            pushes = [(id, data) for (id, data) in pushes if datetime.fromtimestamp(data["date"], utc) >= date]
+        elif "fromchange" in query:
+            node = query["fromchange"][0]
+            found = [id for (id, data) in pushes if any(c["node"].startswith(node) for c in data["changesets"])]
+            pushes = [(id, data) for (id, data) in pushes if found and id > found[0]]
+        else:
+            pushes = pushes[-DEFAULT_PUSHES:]
+
+        full = query.get("full", ["0"])[0] not in ("", "0")
+        results = dict()
+        for (id, data) in pushes:
+            if not full:
+                data = dict(data, changesets = [c["node"] for c in data["changesets"]])
+            results[str(id)] = data
+        return json.dumps(results)
+
+    def patch(self, spec):
+        filename = os.path.join(self.directory, PATCH_DIR, spec)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, "rb") as file:
+            return file.read()
+
+    def listing(self, directory):
+        if directory not in self.tree:
+            return None
+        (dirs, files) = self.tree[directory]
+        lines = ["drwxr-xr-x %s" % name for name in sorted(dirs)]
+        lines.extend("-rw-r--r-- %d %s" % (files[name], name) for name in sorted(files))
+        return "\n".join(lines) + "\n"
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, status, body = "", headers = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests = server.requests + 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            server.errors = server.errors + 1
+            self.respond(500, "Injected error\n")
+            return
+
+        (scheme, netloc, path, query, fragment) = urlsplit(self.path)
+        parts = [unquote(p) for p in path.split("/") if p]
+        query = parse_qs(query, keep_blank_values = True)
+
+        body = None
+        if parts == ["json-pushes"]:
+            body = server.corpus.select_pushes(query)
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.respond(304, headers = { "ETag": etag })
+                return
+            self.respond(200, body, { "ETag": etag })
+            return
+        elif len(parts) == 2 and parts[0] == "raw-rev":
+            body = server.corpus.patch(parts[1])
+        elif len(parts) >= 2 and parts[0] == "file":
+            body = server.corpus.listing("/".join(parts[2:]))
+
+        if body is None:
+            self.respond(404, "Not found\n")
+        else:
+            self.respond(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    corpus = None
+    latency = None
+    error_rate = None
+    random = None
+    requests = None
+    errors = None
+    thread = None
+    connections = None
+    handlers = None
+    stopping = False
+
+    # Serves the corpus on a free local port, delaying every response by
+    # latency seconds and failing error_rate of them with a server error.
+    def __init__(self, corpus, latency = 0, error_rate = 0, seed = 0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandinHandler)
+        self.corpus = corpus if isinstance(corpus, Corpus) else Corpus(corpus)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.connections = set()
+        self.handlers = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def get_request(self):
+        (request, address) = HTTPServer.get_request(self)
+        self.connections.add(request)
+        return (request, address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def process_request(self, request, address):
+        # As ThreadingMixIn but keeping the threads so stop can wait for them
+        thread = Thread(target = self.process_request_thread, args = (request, address))
+        thread.daemon = True
+        self.handlers = [t for t in self.handlers if t.is_alive()]
+        self.handlers.append(thread)
+        thread.start()
+
+    def handle_error(self, request, address):
+        # Requests cut off by stop are expected to fail
+        if not self.stopping:
+            HTTPServer.handle_error(self, request, address)
+
+    def start(self):
+        self.thread = Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # Waits for every handler so none is left running as the interpreter
+        # exits
+        self.stopping = True
+        self.shutdown()
+        # Ends the handlers waiting on kept alive connections
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server_close()
+        self.thread.join()
+        for thread in self.handlers:
+            thread.join()
+
+def write_file(corpus, name, data):
+    filename = os.path.join(corpus, name)
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, "wb") as file:
+        file.write(data)
+
+def record_corpus(ui, url, corpus, start = None):
+    # Saves everything indexing the given pushes from url would fetch
+    results = json.loads(http_fetch("%sjson-pushes?full=1&startID=%d" % (url, start or 0)))
+    if "pushes" in results:
+        results = results["pushes"]
+    write_file(corpus, PUSHES_FILE, json.dumps(results))
+
+    csets = [c for push in results.values() for c in push["changesets"]]
+    for (position, cset) in enumerate(csets):
+        ui.progress("recording patches", position, len(csets))
+        write_file(corpus, os.path.join(PATCH_DIR, cset["node"]),
+                   http_fetch("%sraw-rev/%s" % (url, cset["node"])))
+        for parent in cset["parents"][1:]:
+            spec = "%s:%s" % (parent, cset["node"])
+            write_file(corpus, os.path.join(PATCH_DIR, spec), http_fetch("%sraw-rev/%s" % (url, spec)))
+    ui.progress("recording patches")
+
+    # The tree as of the last changeset, walked the same way as initrepo
+    last = fetch_pushes(ui, url)[-1]["changesets"][-1]
+    queue = HttpQueue()
+    queue.fetch("%sfile/%s/?style=raw" % (url, last), "")
+    files = []
+    (response, directory) = queue.next()
+    while response is not None:
+        for line in response.split("\n"):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            name = line.split(" ", 2)[-1] if line[0] == "-" else line.split(" ", 1)[1]
+            path = name if directory == "" else "%s/%s" % (directory, name)
+            if line[0] == "d":
+                queue.fetch("%sfile/%s/%s/?style=raw" % (url, last, path), path)
+            else:
+                files.append(path)
+        (response, directory) = queue.next()
+    write_file(corpus, MANIFEST_FILE, "\n".join(sorted(files)) + "\n")
+    ui.status("recorded %d pushes, %d changesets and %d files\n" % (len(results), len(csets), len(files)))
+
+def fake_patch(node, parents, user, date, description, changes):
+    lines = [
+        "# HG changeset patch",
+        "# User %s" % user,
+        "# Date %d 0" % date,
+        "# Node ID %s" % node,
+    ]
+    lines.extend("# Parent  %s" % p for p in parents)
+    lines.append(description)
+    lines.append("")
+    for (name, type) in sorted(changes.items()):
+        lines.append("diff --git a/%s b/%s" % (name, name))
+        if type == "A":
+            lines.extend(["new file mode 100644", "--- /dev/null", "+++ b/%s" % name, "@@ -0,0 +1,1 @@", "+added"])
+        elif type == "R":
+            lines.extend(["deleted file mode 100644", "--- a/%s" % name, "+++ /dev/null", "@@ -1,1 +0,0 @@", "-removed"])
+        else:
+            lines.extend(["--- a/%s" % name, "+++ b/%s" % name, "@@ -1,1 +1,1 @@", "-old", "+new"])
+    return "\n".join(lines) + "\n"
+
+def generate_corpus(corpus, pushes = 50, changesets = 4, files = 2000, seed = 0):
+    # Writes a corpus of linear history with the occasional merge. Every push
+    # is within the last pushes hours so all of it is within a default range.
+    rand = random.Random(seed)
+    # Changesets are unique to each corpus so none are found in a patch cache
+    salt = os.urandom(8).encode("hex")
+
+    dirs = [""]
+    for i in range(max(1, files / 20)):
+        parent = rand.choice(dirs)
+        dirs.append("dir%d" % i if parent == "" else "%s/dir%d" % (parent, i))
+    tree = set()
+    for i in range(files):
+        directory = rand.choice(dirs)
+        tree.add("file%d.txt" % i if directory == "" else "%s/file%d.txt" % (directory, i))
+
+    count = [0]
+    def node():
+        count[0] = count[0] + 1
+        return hashlib.sha1("%s:%d" % (salt, count[0])).hexdigest()
+
+    results = dict()
+    history = [NULL_HEX]
+    now = int(time.time())
+    for push_id in range(1, pushes + 1):
+        date = now - (pushes - push_id + 1) * 3600
+        user = "user%d@example.com" % rand.randint(1, 20)
+        csets = []
+        for i in range(changesets):
+            hex = node()
+            changes = dict()
+            for name in rand.sample(sorted(tree), min(len(tree), rand.randint(1, 8))):
+                changes[name] = "M"
+            if rand.random() < 0.3:
+                name = "%s/new%d.txt" % (rand.choice(dirs[1:] or ["new"]), count[0])
+                changes[name] = "A"
+                tree.add(name)
+            if rand.random() < 0.1 and len(tree) > 1:
+                name = rand.choice(sorted(tree))
+                changes[name] = "R"
+                tree.discard(name)
+
+            parents = [history[-1]]
+            description = "Bug %d - Change %d" % (rand.randint(100000, 999999), count[0])
+            if len(history) > 10 and rand.random() < 0.05:
+                parents.append(history[-rand.randint(2, 10)])
+                merged = dict((n, "M") for n in rand.sample(sorted(tree), min(len(tree), 3)))
+                write_file(corpus, os.path.join(PATCH_DIR, "%s:%s" % (parents[1], hex)),
+                           fake_patch(hex, parents, user, date, description, merged))
+            write_file(corpus, os.path.join(PATCH_DIR, hex),
+                       fake_patch(hex, parents, user, date, description, changes))
+
+            csets.append({
+                "node": hex,
+                "author": user,
+                "desc": description,
+                "date": [date, 0],
+                "parents": parents,
+                "files": sorted(changes.keys()),
+            })
+            history.append(hex)
+
+        results[str(push_id)] = { "user": user, "date": date, "changesets": csets }
+
+    write_file(corpus, PUSHES_FILE, json.dumps(results))
+    write_file(corpus, MANIFEST_FILE, "\n".join(sorted(tree)) + "\n")
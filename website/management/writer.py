@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from website.models import *
+
+CHUNK = 500
+
+def changeset_ids(hexes, lock = False):
+    changesets = Changeset.objects.select_for_update() if lock else Changeset.objects.all()
+    ids = dict()
+    hexes = list(hexes)
+    for i in range(0, len(hexes), CHUNK):
+        chunk = hexes[i:i + CHUNK]
+        ids.update(changesets.filter(hex__in = chunk).values_list("hex", "id"))
+    return ids
+
+def path_changesets(repository, root, links):
+    # The rows of the path index for links of (push id, changeset id, index).
+    # The types beneath each path are found through the ancestors of the
+    # changes, so the changes must already be written.
+    masks = dict()
+    ids = list(set(id for (push_id, id, index) in links))
+    for i in range(0, len(ids), CHUNK):
+        ancestors = Ancestor.objects.filter(path__changes__changeset__in = ids[i:i + CHUNK])
+        for (id, path, type) in ancestors.values_list("path__changes__changeset", "ancestor", "path__changes__type").distinct():
+            paths = masks.setdefault(id, dict())
+            paths[path] = paths.get(path, 0) | CHANGE_MASKS[type]
+
+    rows = []
+    for (push_id, id, index) in links:
+        paths = masks.get(id, { root.id: 0 })
+        for (path, types) in paths.iteritems():
+            rows.append(PathChangeset(repository = repository, path_id = path, push_id = push_id,
+                                      index = index, changeset_id = id, types = types))
+    return rows
+
+class IndexWriter(object):
+    repository = None
+    resolver = None
+    changesets = None
+    push_ids = None
+    pushes = None
+    new_changesets = None
+    parents = None
+    changes = None
+    links = None
+
+    # Stages the rows for a group of pushes and writes them with bulk inserts in
+    # dependency order when flushed. Pushes and changesets use database assigned
+    # ids so those are looked up again after insertion, a query per chunk, before
+    # the rows that reference them are written. Paths are resolved and written
+    # by the given PathResolver.
+    def __init__(self, repository, resolver, hexes = ()):
+        self.repository = repository
+        self.resolver = resolver
+        self.changesets = changeset_ids(hexes)
+        self.push_ids = dict()
+        self.reset()
+
+    def reset(self):
+        self.pushes = []
+        self.new_changesets = dict()
+        self.parents = []
+        self.changes = []
+        self.links = []
+
+    def has_changeset(self, hex):
+        return hex in self.changesets or hex in self.new_changesets
+
+    def staged_changesets(self):
+        return len(self.new_changesets)
+
+    def add_push(self, push_id, user, date):
+        self.pushes.append(Push(push_id = push_id, repository = self.repository, user = user, date = date))
+
+    # Continues a push that was partly written by an earlier run, returning the
+    # index that the next changeset in the push should use.
+    def resume_push(self, push_id):
+        push = Push.objects.get(repository = self.repository, push_id = push_id)
+        self.push_ids[push_id] = push.id
+        return push.changesets.count()
+
+    def add_changeset(self, hex, author, date, tzoffset, description, parents, files):
+        self.new_changesets[hex] = Changeset(hex = hex, author = author, date = date,
+                                             tzoffset = tzoffset, description = description,
+                                             types = change_mask(files.itervalues()), change_count = len(files))
+
+        for parent in parents:
+            self.parents.append((hex, parent))
+
+        for (file, changetype) in files.iteritems():
+            path = self.resolver.get_path(file)
+            self.changes.append((hex, path, changetype))
+
+    def add_push_changeset(self, push_id, hex, index):
+        self.links.append((push_id, hex, index))
+
+    def flush(self):
+        # Changesets that were already indexed, perhaps for another repository,
+        # are linked without their changes being staged so their paths are
+        # added to this repository's tree here
+        known = list(set(self.changesets[hex] for (push_id, hex, index) in self.links if hex not in self.new_changesets))
+        for i in range(0, len(known), CHUNK):
+            for path in Change.objects.filter(changeset__in = known[i:i + CHUNK]).values_list("path__path", flat = True):
+                self.resolver.get_path(path)
+
+        # This locks the index so changesets another process has indexed since
+        # they were looked up can be found and used instead
+        self.resolver.flush()
+        existing = changeset_ids(self.new_changesets.keys(), lock = True)
+        if len(existing) > 0:
+            for hex in existing:
+                del self.new_changesets[hex]
+            self.parents = [(hex, parent) for (hex, parent) in self.parents if hex not in existing]
+            self.changes = [(hex, path, type) for (hex, path, type) in self.changes if hex not in existing]
+            self.changesets.update(existing)
+
+        Push.objects.bulk_create(self.pushes)
+        self.push_ids.update(Push.objects.filter(repository = self.repository,
+                                                 push_id__in = [p.push_id for p in self.pushes]).values_list("push_id", "id"))
+
+        Changeset.objects.bulk_create(self.new_changesets.values())
+        self.changesets.update(changeset_ids(self.new_changesets.keys()))
+
+        ChangesetParent.objects.bulk_create([ChangesetParent(changeset_id = self.changesets[hex], parenthex = parent)
+                                             for (hex, parent) in self.parents])
+        Change.objects.bulk_create([Change(id = Change.next_id(), changeset_id = self.changesets[hex], path = path, type = changetype)
+                                    for (hex, path, changetype) in self.changes])
+        PushChangeset.objects.bulk_create([PushChangeset(push_id = self.push_ids[push_id], changeset_id = self.changesets[hex], index = index)
+                                           for (push_id, hex, index) in self.links])
+        PathChangeset.objects.bulk_create(path_changesets(self.repository, self.resolver.root,
+                                                          [(push_id, self.changesets[hex], index) for (push_id, hex, index) in self.links]))
+
+        self.reset()
@@ -2,10 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from django.db import models
+from django.db import models, connection, connections, IntegrityError
+from django.db.utils import load_backend
 from django.conf import settings
 from pytz import FixedOffset
 
+import hashlib
+import os
+import threading
+
 DATABASE_ENGINE = settings.DATABASES['default']['ENGINE']
 
 CHANGE_TYPES = (
@@ -14,16 +19,101 @@ CHANGE_TYPES = (
     ("R", "Removed"),
 )
 
+# Each type of change as a bit in a mask of the types of a set of changes
+CHANGE_MASKS = {
+    "A": 1,
+    "M": 2,
+    "R": 4,
+}
+
+def change_mask(types):
+    mask = 0
+    for type in types:
+        mask = mask | CHANGE_MASKS[type]
+    return mask
+
+def mask_types(mask):
+    return set(type for (type, bit) in CHANGE_MASKS.iteritems() if mask & bit)
+
+# The masks that include any of types
+def masks_including(types):
+    mask = change_mask(types)
+    return [m for m in range(1, change_mask(CHANGE_MASKS.keys()) + 1) if m & mask]
+
+# The number of ids reserved by a process at a time
+ID_BLOCK = 1000
+# The number of ids looked up by each query
+PATH_CHUNK = 500
+
+class IdSequence(models.Model):
+    name = models.CharField(max_length = 100, primary_key = True)
+    next_id = models.IntegerField()
+
+def sequence_connection():
+    # Reservations are committed straight away on a connection of their own so
+    # other processes are never left waiting for the caller's transaction.
+    # SQLite only allows one writer at a time so there the default connection
+    # has to be used.
+    if DATABASE_ENGINE == 'django.db.backends.sqlite3':
+        return connection
+
+    pid = os.getpid()
+    if sequence_connection.pid != pid:
+        backend = load_backend(DATABASE_ENGINE)
+        sequence_connection.connection = backend.DatabaseWrapper(connections.databases['default'],
+                                                                 allow_thread_sharing = True)
+        sequence_connection.pid = pid
+    return sequence_connection.connection
+sequence_connection.pid = None
+sequence_connection.connection = None
+
+def reserve_ids(table, count, conn = None):
+    # Atomically reserves count ids for table, returning the range as
+    # (first, limit). The sequence starts after the table's current maximum id.
+    if conn is None:
+        conn = sequence_connection()
+    quote = conn.ops.quote_name
+    sequence = quote(IdSequence._meta.db_table)
+
+    cursor = conn.cursor()
+    while True:
+        cursor.execute("UPDATE %s SET next_id = next_id + %%s WHERE name = %%s" % sequence, [count, table])
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT MAX(id) FROM %s" % quote(table))
+            max_id = cursor.fetchone()[0] or 0
+            try:
+                cursor.execute("INSERT INTO %s (name, next_id) VALUES (%%s, %%s)" % sequence, [table, max_id + 1 + count])
+            except IntegrityError:
+                # Another process created the sequence first
+                if conn is connection:
+                    raise
+                conn._rollback()
+                continue
+
+        cursor.execute("SELECT next_id FROM %s WHERE name = %%s" % sequence, [table])
+        limit = cursor.fetchone()[0]
+        if conn is not connection:
+            conn._commit()
+        return (limit - count, limit)
+
+ID_LOCK = threading.Lock()
+
 class ManagedPrimaryKey(models.Model):
+    # Ids are handed out from blocks reserved from the IdSequence table so
+    # concurrent indexing processes and threads never use the same id.
+    @classmethod
+    def reset_ids(cls):
+        with ID_LOCK:
+            cls.id_range = None
+
     @classmethod
     def next_id(cls):
-        if not hasattr(cls, "max_id"):
-            max_id = cls.objects.aggregate(models.Max('id'))["id__max"]
-            if max_id is None:
-                max_id = 0
-            setattr(cls, "max_id", max_id)
-        cls.max_id = cls.max_id + 1
-        return cls.max_id
+        with ID_LOCK:
+            if getattr(cls, "id_range", None) is None or cls.id_range[0] == cls.id_range[1]:
+                cls.id_range = reserve_ids(cls._meta.db_table, ID_BLOCK)
+            (next_id, limit) = cls.id_range
+            cls.id_range = (next_id + 1, limit)
+            return next_id
 
     class Meta:
         abstract = True
@@ -38,47 +128,93 @@ class Repository(models.Model):
     def root(self):
         return Path.get_by_path('')
 
+    # Whether the path index lists every changeset pushed to the repository.
+    # Every changeset is listed under the root and backfillpathindex adds the
+    # oldest last, so it is enough to look for the oldest.
+    def has_path_index(self):
+        oldest = PushChangeset.objects.filter(push__repository = self).order_by("push__push_id", "index")
+        oldest = oldest.values_list("push__push_id", "index")[:1]
+        if len(oldest) == 0:
+            return True
+        (push_id, index) = oldest[0]
+        return PathChangeset.objects.filter(repository = self, push_id = push_id, index = index).exists()
+
     def get_absolute_url(self):
         return self.url
 
     def __unicode__(self):
         return self.name
 
+class Checkpoint(models.Model):
+    repository = models.OneToOneField(Repository, related_name = "checkpoint")
+    # The last push written for the repository
+    push_id = models.IntegerField()
+    # The position in the push of the next changeset to index, null once the
+    # whole push has been written
+    index = models.IntegerField(null = True)
+    # The validator the pushlog sent when it last had nothing new
+    etag = models.CharField(max_length = 200, blank = True, default = "")
+    # When old pushes were last expired
+    expired = models.DateTimeField(null = True)
+
+def path_hash(path):
+    return hashlib.sha1(path.encode("utf8") if isinstance(path, unicode) else path).hexdigest()
+
+def join_path(parent, name):
+    return name if parent == '' else "%s/%s" % (parent, name)
+
 class Path(ManagedPrimaryKey):
     id = models.IntegerField(primary_key = True)
     name = models.CharField(max_length = 200, db_index = True)
     parent = models.ForeignKey("self", null = True, related_name = "children")
     repositories = models.ManyToManyField(Repository, related_name = "paths")
     is_dir = models.BooleanField()
+    # The full path and the number of directories above it. Paths are shared by
+    # every repository so the full path is unique across the table, the hash
+    # is indexed as paths can be too long to index directly.
+    path = models.TextField(default = '')
+    path_hash = models.CharField(max_length = 40, null = True, unique = True)
+    depth = models.IntegerField(default = 0)
+    # A pre-order interval containing the intervals of everything beneath the
+    # path so a subtree is a range of lft. Directories keep unused space at the
+    # end of their interval, starting at free, for paths added later.
+    lft = models.BigIntegerField(null = True, db_index = True)
+    rgt = models.BigIntegerField(null = True)
+    free = models.BigIntegerField(null = True)
+
+    # The filter for this path and everything beneath it through relation,
+    # falling back to the ancestors if the intervals haven't been built.
+    def subtree_filter(self, relation):
+        if self.lft is None:
+            return { relation + "__ancestors__ancestor": self }
+        return { relation + "__lft__range": (self.lft, self.rgt) }
 
     def parentlist(self):
-        if self.parent:
-            return [a.ancestor for a in Ancestor.objects.filter(path = self).exclude(ancestor = self)]
-        return []
+        if self.parent_id is None:
+            return []
+
+        names = self.path.split('/')
+        paths = [''] + ['/'.join(names[:i]) for i in range(1, len(names))]
+        return list(Path.objects.filter(path_hash__in = [path_hash(p) for p in paths]).order_by("depth"))
 
     @classmethod
     def get_by_path(cls, path):
-        if path == '':
-            return Path.objects.get(parent = None)
-
-        names = path.split('/')
+        return Path.objects.get(path_hash = path_hash(path))
 
-        filter = dict()
-        rel = ""
-        for name in reversed(names):
-            filter[rel + "name"] = name
-            rel = "parent__" + rel
-        filter[rel + "parent"] = None
-
-        return Path.objects.get(**filter)
+    # Maps the ids of paths to their full paths. A query set of ids is used as a
+    # subquery so only a single query is made, otherwise one is made for each
+    # chunk of ids.
+    @classmethod
+    def resolve_paths(cls, ids):
+        paths = Path.objects.order_by()
+        if isinstance(ids, models.query.QuerySet):
+            return dict(paths.filter(id__in = ids).values_list("id", "path"))
 
-    @property
-    def path(self):
-        if self.parent:
-            paths = self.parentlist()[1:]
-            paths.append(self)
-            return '/'.join([p.name for p in paths])
-        return ''
+        result = dict()
+        ids = list(ids)
+        for i in range(0, len(ids), PATH_CHUNK):
+            result.update(paths.filter(id__in = ids[i:i + PATH_CHUNK]).values_list("id", "path"))
+        return result
 
     def __unicode__(self):
         return self.path
@@ -87,6 +223,13 @@ class Path(ManagedPrimaryKey):
         unique_together = ("parent", "name")
         ordering = ["name"]
 
+def lock_index():
+    # Locks the root path until the transaction ends so only one process at a
+    # time writes new paths and changesets. Reads made while holding the lock
+    # with select_for_update also see whatever other processes committed
+    # since the transaction started.
+    list(Path.objects.select_for_update().filter(parent = None).values_list("id", flat = True))
+
 class Ancestor(models.Model):
     path = models.ForeignKey(Path, related_name = "ancestors")
     ancestor = models.ForeignKey(Path, related_name = "+")
@@ -99,17 +242,21 @@ class Push(models.Model):
     push_id = models.IntegerField()
     repository = models.ForeignKey(Repository, related_name = "pushes")
     user = models.TextField()
-    date = models.DateTimeField()
+    date = models.DateTimeField(db_index = True)
 
     class Meta:
         unique_together = ("repository", "push_id")
 
 class Changeset(models.Model):
-    hex = models.CharField(max_length = 40, db_index = True)
+    hex = models.CharField(max_length = 40, unique = True)
     author = models.TextField()
     date = models.DateTimeField()
     tzoffset = models.IntegerField()
     description = models.TextField()
+    # The types of the changes as a mask of CHANGE_MASKS and their number,
+    # null if the changeset was indexed before these were stored
+    types = models.IntegerField(null = True)
+    change_count = models.IntegerField(null = True)
 
     @property
     def localdate(self):
@@ -120,20 +267,27 @@ class Changeset(models.Model):
     def shorthex(self):
         return self.hex[0:12]
 
+    # Filled in by website.graph.prefetch_graph
+    prefetched_parents = None
+    prefetched_children = None
+
     @property
     def parents(self):
-        return (p.parent for p in self.parentchangesets.all())
+        if self.prefetched_parents is not None:
+            return iter(self.prefetched_parents)
+        return (p.parent for p in self.parentchangesets.order_by("id"))
 
     @property
     def children(self):
-        return (c.changeset for c in ChangesetParent.objects.filter(parenthex = self.hex))
+        if self.prefetched_children is not None:
+            return iter(self.prefetched_children)
+        return (c.changeset for c in ChangesetParent.objects.filter(parenthex = self.hex).order_by("id"))
 
     @property
     def changetypes(self):
-        changes = set()
-        for change in self.changes.all():
-            changes.add(change.type)
-        return changes
+        if self.types is None:
+            return set(self.changes.values_list("type", flat = True).distinct())
+        return mask_types(self.types)
 
     def __unicode__(self):
         return self.shorthex
@@ -171,3 +325,20 @@ class Change(ManagedPrimaryKey):
 
     class Meta:
         unique_together = ("changeset", "path")
+
+class PathChangeset(models.Model):
+    # The changesets pushed to a repository listed under every path at or above
+    # the paths they changed, with the types of the changes beneath the path as
+    # a mask. Every changeset is listed under the root. Rows are ordered as the
+    # pushes are so the newest changesets beneath a path are a single range of
+    # the index.
+    repository = models.ForeignKey(Repository, related_name = "+")
+    path = models.ForeignKey(Path, related_name = "+")
+    push_id = models.IntegerField()
+    index = models.IntegerField()
+    changeset = models.ForeignKey(Changeset, related_name = "+")
+    types = models.IntegerField()
+
+    class Meta:
+        unique_together = ("repository", "path", "push_id", "index")
+        index_together = [("repository", "push_id")]
@@ -5,12 +5,52 @@
 from django.core.cache import cache
 from django.views.decorators.http import etag
 
+from website.models import Change, Changeset, Path, PathChangeset, masks_including
+
 TYPEMAP = {
     "added": "A",
     "removed": "R",
     "modified": "M",
 }
 
+def recent_changesets(repository, path, types, limit):
+    # The newest changesets pushed to repository with changes to path or
+    # beneath it, of the given types if any. Until the path index has been
+    # backfilled they are found through the intervals of the changed paths.
+    if repository.has_path_index():
+        entries = PathChangeset.objects.filter(repository = repository, path = path)
+        if types is not None:
+            entries = entries.filter(types__in = masks_including(types))
+        entries = entries.select_related("changeset").order_by("-push_id", "-index")
+        return [e.changeset for e in entries[:limit]]
+
+    queryparams = {
+        "pushes__push__repository": repository,
+    }
+
+    if path.parent_id is not None:
+        queryparams.update(path.subtree_filter("changes__path"))
+
+    if types is not None:
+        queryparams["changes__type__in"] = types
+
+    changesets = Changeset.objects.filter(**queryparams).distinct().order_by("-pushes__push__push_id", "-pushes__index")
+    return list(changesets[:limit])
+
+def changeset_changes(changesets):
+    # Maps the id of each changeset to its changes sorted by path, with the
+    # full path of each change resolved in bulk into fullpath
+    changes = Change.objects.filter(changeset__in = changesets)
+    paths = Path.resolve_paths(changes.values_list("path_id", flat = True))
+
+    result = dict((c.id, []) for c in changesets)
+    for change in changes:
+        change.fullpath = paths[change.path_id]
+        result[change.changeset_id].append(change)
+    for items in result.itervalues():
+        items.sort(key = lambda c: c.fullpath)
+    return result
+
 def tag_cached(func, tag, *args):
     def tag_func(*args):
         return tag
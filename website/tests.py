@@ -5,8 +5,38 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
 
+from django.conf import settings
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.db.utils import load_backend
+from django.test import TestCase, TransactionTestCase
+from django.utils.unittest import skipIf
+from pytz import utc
+
+from base.utils import config
+
+import website.graph
+from website import models
+from website.models import Path, Repository, Changeset, ChangesetParent, Change, Push, PushChangeset, PathChangeset, Checkpoint, reserve_ids, masks_including
+from website.graph import ChangesetGraph, prefetch_graph
+from website.shared import recent_changesets
+from website.management.paths import PathResolver
+from website.management.writer import IndexWriter
+from website.management.command import UICommand
+from website.management.http import get_client
+from website.management.patch import split_patches
+from website.management.repo import update_repository, expire_changesets, add_pushes, NULL_HEX
+from website.management.standin import StandinServer, Corpus, generate_corpus, fake_patch
+from website.management.commands.initrepo import add_paths
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +44,546 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+def in_memory_database():
+    # Checked before the test database is created, sqlite tests use an
+    # in-memory database unless TEST_NAME names a file
+    if connection.vendor != 'sqlite':
+        return False
+    return connection.settings_dict.get('TEST_NAME') in (None, '', ':memory:')
+
+class IdAllocatorTest(TransactionTestCase):
+    def setUp(self):
+        self.block = models.ID_BLOCK
+        models.ID_BLOCK = 7
+        Path.reset_ids()
+
+    def tearDown(self):
+        models.ID_BLOCK = self.block
+        Path.reset_ids()
+
+    def test_blocks_start_after_existing_ids(self):
+        max_id = Path.objects.aggregate(Max("id"))["id__max"] or 0
+        self.assertTrue(Path.next_id() > max_id)
+
+    def test_blocks_do_not_overlap(self):
+        ids = []
+        for i in range(20):
+            ids.append(Path.next_id())
+            # Simulates another process taking over
+            if i % 3 == 0:
+                Path.reset_ids()
+        self.assertEqual(len(ids), len(set(ids)))
+
+    @skipIf(in_memory_database(), "Threads cannot share an in-memory database")
+    def test_concurrent_allocators(self):
+        results = []
+        errors = []
+
+        def allocate():
+            # Each allocator has its own connection like a separate process
+            backend = load_backend(settings.DATABASES['default']['ENGINE'])
+            conn = backend.DatabaseWrapper(connections.databases['default'])
+            try:
+                for i in range(50):
+                    results.append(reserve_ids(Path._meta.db_table, 3, conn))
+            except:
+                errors.append(sys.exc_info()[1])
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target = allocate) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        ids = [id for (first, limit) in results for id in range(first, limit)]
+        self.assertEqual(len(ids), 8 * 50 * 3)
+        self.assertEqual(len(ids), len(set(ids)))
+
+    @skipIf(connection.vendor == 'sqlite', "SQLite reservations are part of each thread's open transaction")
+    def test_concurrent_threads(self):
+        results = []
+
+        def allocate():
+            for i in range(200):
+                results.append(Path.next_id())
+            connection.close()
+
+        threads = [threading.Thread(target = allocate) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8 * 200)
+        self.assertEqual(len(results), len(set(results)))
+
+    def test_threads_sharing_a_connection(self):
+        # Threads take ids from the same blocks, reserving new ones through a
+        # single connection as the blocks run out, so this runs on SQLite too
+        conn = connections['default']
+        sequence_connection = models.sequence_connection
+        models.sequence_connection = lambda: conn
+        conn.allow_thread_sharing = True
+        results = []
+
+        def allocate():
+            ids = [Path.next_id() for i in range(200)]
+            results.extend(ids)
+
+        try:
+            threads = [threading.Thread(target = allocate) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            models.sequence_connection = sequence_connection
+            conn.allow_thread_sharing = False
+
+        self.assertEqual(len(results), 8 * 200)
+        self.assertEqual(len(results), len(set(results)))
+
+class QuietUI(UICommand):
+    # Keeps warnings for the test to check rather than writing them out
+    verbosity = 0
+
+    def __init__(self):
+        UICommand.__init__(self)
+        self.warnings = []
+
+    def warn(self, str):
+        self.warnings.append(str)
+
+    error = warn
+
+class NestedIntervals(object):
+    def assertNested(self):
+        paths = dict((p.id, p) for p in Path.objects.all())
+        for path in paths.itervalues():
+            self.assertTrue(path.lft <= path.rgt)
+            if path.parent_id is not None:
+                parent = paths[path.parent_id]
+                self.assertTrue(parent.lft < path.lft and path.rgt < parent.free <= parent.rgt + 1)
+            if path.is_dir:
+                self.assertEqual(set(Path.objects.filter(lft__range = (path.lft, path.rgt))),
+                                 set(Path.objects.filter(ancestors__ancestor = path)))
+
+class PathTest(NestedIntervals, TestCase):
+    def setUp(self):
+        self.repository = Repository(name = "test", url = "http://localhost/test/", range = 86400)
+        self.repository.save()
+
+        resolver = PathResolver(self.repository)
+        self.file = resolver.get_path("a/b/c/file.txt")
+        resolver.get_path("a/d")
+        resolver.flush()
+
+    def test_get_by_path(self):
+        with self.assertNumQueries(1):
+            path = Path.get_by_path("a/b/c/file.txt")
+        with self.assertNumQueries(0):
+            self.assertEqual(path.path, "a/b/c/file.txt")
+            self.assertEqual(path.depth, 4)
+        self.assertEqual(path.id, self.file.id)
+        self.assertEqual(Path.get_by_path("").parent, None)
+        self.assertRaises(Path.DoesNotExist, Path.get_by_path, "a/b/missing")
+
+    def test_non_ascii(self):
+        # Names from patches are UTF-8 and match the unicode names loaded
+        # from the database
+        resolver = PathResolver(self.repository)
+        path = resolver.get_path("a/caf\xc3\xa9.txt")
+        self.assertEqual(path.path, u"a/caf\xe9.txt")
+        self.assertEqual(resolver.get_path(u"a/caf\xe9.txt").id, path.id)
+        resolver.flush()
+        self.assertEqual(Path.get_by_path(u"a/caf\xe9.txt").id, path.id)
+
+        resolver = PathResolver(self.repository)
+        self.assertEqual(resolver.get_path("a/caf\xc3\xa9.txt").id, path.id)
+        self.assertEqual(resolver.linked_path("a/caf\xc3\xa9.txt").id, path.id)
+        self.assertEqual(resolver.staged(), 0)
+
+    def test_parentlist(self):
+        with self.assertNumQueries(1):
+            parents = self.file.parentlist()
+        self.assertEqual([p.path for p in parents], ["", "a", "a/b", "a/b/c"])
+
+    def test_backfill(self):
+        Path.objects.update(path = "", path_hash = None, depth = 0)
+        call_command("backfillpaths", verbosity = 0)
+        self.assertEqual(Path.get_by_path("a/d").depth, 2)
+        self.assertEqual(Path.get_by_path("a/b/c/file.txt").id, self.file.id)
+
+    def test_intervals(self):
+        self.assertNested()
+
+        resolver = PathResolver(self.repository)
+        resolver.get_path("a/b/e/file.txt")
+        resolver.get_path("f")
+        resolver.flush()
+        self.assertNested()
+
+        call_command("rebuildintervals", verbosity = 0)
+        self.assertNested()
+        self.assertEqual(Path.get_by_path("a/b/c/file.txt").id, self.file.id)
+
+    def test_intervals_renumbered(self):
+        # A directory without space left renumbers everything
+        directory = Path.get_by_path("a/b/c")
+        Path.objects.filter(id = directory.id).update(free = directory.rgt + 1)
+        resolver = PathResolver(self.repository)
+        resolver.get_path("a/b/c/new/file.txt")
+        resolver.flush()
+        self.assertNested()
+        self.assertTrue(Path.get_by_path("a/b/c").free <= Path.get_by_path("a/b/c").rgt)
+
+    def test_intervals_never_built(self):
+        # New paths are left without intervals until they are built
+        Path.objects.update(lft = None, rgt = None, free = None)
+        resolver = PathResolver(self.repository)
+        resolver.get_path("a/new/deeper/file.txt")
+        resolver.get_path("g/file.txt")
+        resolver.flush()
+        self.assertFalse(Path.objects.filter(lft__isnull = False).exists())
+        self.assertFalse(Path.objects.filter(free__isnull = False).exists())
+
+        call_command("rebuildintervals", verbosity = 0)
+        self.assertNested()
+
+class IngestTest(NestedIntervals, TransactionTestCase):
+    # Indexes a generated corpus served by the stand-in for hgweb
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        generate_corpus(self.directory, pushes = 6, changesets = 3, files = 60)
+        self.corpus = Corpus(self.directory)
+        self.server = StandinServer(self.corpus)
+        self.server.start()
+
+        if not config.has_section("hgchangefeed"):
+            config.add_section("hgchangefeed")
+        config.set("hgchangefeed", "cachedir", tempfile.mkdtemp())
+
+        keep = timedelta(days = 1).total_seconds() * 2
+        self.repository = Repository(name = "standin", url = self.server.url, range = keep)
+        self.repository.save()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(config.get("hgchangefeed", "cachedir"), True)
+        config.remove_option("hgchangefeed", "cachedir")
+        shutil.rmtree(self.directory, True)
+
+    def test_ingest(self):
+        ui = QuietUI()
+        add_paths(ui, self.repository)
+        self.assertEqual(update_repository(ui, self.repository), 6)
+        self.assertEqual(Changeset.objects.count(), self.corpus.changeset_count())
+        self.assertEqual(Push.objects.filter(repository = self.repository).count(), 6)
+        self.assertTrue(self.repository.paths.count() > 60)
+
+        checkpoint = Checkpoint.objects.get(repository = self.repository)
+        self.assertEqual((checkpoint.push_id, checkpoint.index), (6, None))
+
+    def test_resume(self):
+        # A failure part way through a push leaves the changesets before it
+        # committed and the next update carries on from the checkpoint
+        ui = QuietUI()
+        config.set("hgchangefeed", "writechangesets", "1")
+        (push_id, data) = self.corpus.pushes[2]
+        missing = data["changesets"][1]["node"]
+        patches = os.path.join(self.directory, "raw-rev")
+        moved = [n for n in os.listdir(patches) if n.endswith(missing)]
+        for name in moved:
+            os.rename(os.path.join(patches, name), os.path.join(self.directory, name))
+        try:
+            self.assertEqual(update_repository(ui, self.repository), None)
+        finally:
+            config.remove_option("hgchangefeed", "writechangesets")
+            for name in moved:
+                os.rename(os.path.join(self.directory, name), os.path.join(patches, name))
+
+        self.assertIn("failed indexing changeset %s\n" % missing, ui.warnings)
+        checkpoint = Checkpoint.objects.get(repository = self.repository)
+        self.assertEqual((checkpoint.push_id, checkpoint.index), (push_id, 1))
+        self.assertFalse(Changeset.objects.filter(hex = missing).exists())
+        self.assertEqual(PushChangeset.objects.filter(push__push_id = push_id).count(), 1)
+
+        self.assertEqual(update_repository(ui, self.repository), 6 - push_id + 1)
+        checkpoint = Checkpoint.objects.get(repository = self.repository)
+        self.assertEqual((checkpoint.push_id, checkpoint.index), (6, None))
+        self.assertEqual(Changeset.objects.count(), self.corpus.changeset_count())
+        self.assertEqual(Push.objects.filter(repository = self.repository).count(), 6)
+        for (id, data) in self.corpus.pushes:
+            pushed = PushChangeset.objects.filter(push__repository = self.repository, push__push_id = id)
+            self.assertEqual(list(pushed.order_by("index").values_list("changeset__hex", "index")),
+                             [(c["node"], index) for (index, c) in enumerate(data["changesets"])])
+        self.assertNested()
+
+    def test_change_types(self):
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+
+        changesets = list(Changeset.objects.all())
+        expected = dict((c.id, (set(c.changes.values_list("type", flat = True)), c.changes.count())) for c in changesets)
+        with self.assertNumQueries(0):
+            found = dict((c.id, (c.changetypes, c.change_count)) for c in changesets)
+        self.assertEqual(found, expected)
+
+        Changeset.objects.update(types = None, change_count = None)
+        call_command("backfilltypes", verbosity = 0)
+        self.assertEqual(dict((c.id, (c.changetypes, c.change_count)) for c in Changeset.objects.all()), expected)
+
+    def test_render_queries(self):
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+        self.repository.hidden = False
+        self.repository.save()
+
+        # The queries made don't depend on the number of changes
+        changeset = max(Changeset.objects.all(), key = lambda c: c.change_count)
+        self.assertTrue(changeset.change_count > 1)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("changeset", args = [self.repository.name, changeset.hex]))
+        paths = sorted(c.path.path for c in changeset.changes.all())
+        self.assertContains(response, paths[0])
+        self.assertContains(response, paths[-1])
+
+        # Two of them check the path index is complete
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse("feed", args = [self.repository.name, ""]))
+        self.assertContains(response, paths[0])
+
+    def test_graph(self):
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+
+        changesets = list(Changeset.objects.all())
+        expected = dict((c.hex, ([p.hex if p else None for p in c.parents], [k.hex for k in c.children])) for c in changesets)
+        self.assertTrue(any(len(parents) > 1 for (parents, children) in expected.itervalues()))
+
+        with self.assertNumQueries(3):
+            prefetch_graph(changesets)
+        with self.assertNumQueries(0):
+            found = dict((c.hex, ([p.hex if p else None for p in c.parents], [k.hex for k in c.children])) for c in changesets)
+        self.assertEqual(found, expected)
+
+        # Long lists of changesets are looked up a chunk at a time
+        website.graph.PATH_CHUNK = 4
+        try:
+            changesets = prefetch_graph(Changeset.objects.all())
+        finally:
+            website.graph.PATH_CHUNK = models.PATH_CHUNK
+        found = dict((c.hex, ([p.hex if p else None for p in c.parents], [k.hex for k in c.children])) for c in changesets)
+        self.assertEqual(found, expected)
+
+        with self.assertNumQueries(2):
+            graph = ChangesetGraph(self.repository)
+        for changeset in changesets:
+            (parents, children) = expected[changeset.hex]
+            self.assertEqual(graph.changeset_id(changeset.hex), changeset.id)
+            self.assertEqual([p for p in parents if p is not None], [p for p in graph.parents(changeset.hex) if graph.changeset_id(p)])
+            self.assertEqual(children, graph.children(changeset.hex))
+            self.assertEqual(graph.is_merge(changeset.hex), len(parents) > 1)
+
+        newest = PushChangeset.objects.order_by("-push__push_id", "-index")[0].changeset.hex
+        ancestors = list(graph.ancestors(newest))
+        self.assertEqual(len(ancestors), len(set(ancestors)))
+        self.assertEqual(ancestors[0], graph.parents(newest)[0])
+        self.assertEqual(list(graph.ancestors(newest, 2)), ancestors[:2])
+
+    def test_fetch_error(self):
+        # A repository the server can't find doesn't stop others updating
+        ui = QuietUI()
+        missing = Repository(name = "missing", url = "%smissing/" % self.server.url, range = self.repository.range)
+        missing.save()
+        self.assertEqual(update_repository(ui, missing), None)
+        self.assertTrue(any("HttpError" in w for w in ui.warnings))
+        self.assertEqual(update_repository(ui, self.repository), 6)
+
+    def test_noop_update(self):
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+        self.assertEqual(update_repository(ui, self.repository), 0)
+        self.assertNotEqual(Checkpoint.objects.get(repository = self.repository).etag, "")
+        # The second poll is answered by the stored validator
+        self.assertEqual(update_repository(ui, self.repository), 0)
+        self.assertEqual(get_client().requests, 1)
+        self.assertEqual(Push.objects.filter(repository = self.repository).count(), 6)
+
+    def test_path_index(self):
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+        pushed = PushChangeset.objects.filter(push__repository = self.repository).count()
+        self.assertEqual(PathChangeset.objects.filter(repository = self.repository, path = Path.get_by_path("")).count(), pushed)
+
+        # Matches the join through the ancestors of the changes, the root lists
+        # changesets without changes too
+        for path in Path.objects.filter(repositories = self.repository, depth__lte = 2):
+            for types in (None, ["A"], ["M", "R"]):
+                params = { "pushes__push__repository": self.repository }
+                if path.parent_id is not None:
+                    params["changes__path__ancestors__ancestor"] = path
+                entries = PathChangeset.objects.filter(repository = self.repository, path = path)
+                if types is not None:
+                    params["changes__type__in"] = types
+                    entries = entries.filter(types__in = masks_including(types))
+                changesets = Changeset.objects.filter(**params).distinct().order_by("-pushes__push__push_id", "-pushes__index")
+                self.assertEqual([e.changeset_id for e in entries.order_by("-push_id", "-index")],
+                                 [c.id for c in changesets])
+
+        self.repository.range = 0
+        expire_changesets(ui, self.repository)
+        self.assertEqual(PathChangeset.objects.count(), 0)
+
+    def test_path_index_fallback(self):
+        # Until the path index is backfilled changesets are found through the
+        # intervals of the changed paths instead, with the same results
+        ui = QuietUI()
+        update_repository(ui, self.repository)
+        self.repository.hidden = False
+        self.repository.save()
+
+        cases = [(path, types) for path in Path.objects.filter(repositories = self.repository, depth__lte = 2)
+                               for types in (None, ["A"], ["M", "R"])]
+        self.assertTrue(self.repository.has_path_index())
+        expected = [[c.id for c in recent_changesets(self.repository, p, t, 200)] for (p, t) in cases]
+
+        PathChangeset.objects.filter(repository = self.repository, push_id = 1).delete()
+        self.assertFalse(self.repository.has_path_index())
+        self.assertEqual([[c.id for c in recent_changesets(self.repository, p, t, 200)] for (p, t) in cases], expected)
+
+        directory = Path.objects.filter(repositories = self.repository, is_dir = True, depth = 1)[0]
+        changeset = recent_changesets(self.repository, directory, None, 1)[0]
+        response = self.client.get(reverse("path", args = [self.repository.name, directory.path]))
+        self.assertContains(response, changeset.hex[:12])
+
+        call_command("backfillpathindex", "standin", verbosity = 0)
+        self.assertTrue(self.repository.has_path_index())
+        self.assertEqual([[c.id for c in recent_changesets(self.repository, p, t, 200)] for (p, t) in cases], expected)
+
+class PatchSource(object):
+    # Serves patches generated by the stand-in from memory
+    def __init__(self, patches):
+        self.exported = dict()
+        for text in patches:
+            for patch in split_patches(text.splitlines(True)):
+                self.exported[patch.hex] = patch
+
+    def patches(self, ui, repository, csets):
+        for cset in csets:
+            yield (cset, [self.exported[cset]])
+
+def pushlog_push(id, changesets, date = None):
+    # A push from the full pushlog, changesets holding (node, parents, files)
+    push = { "id": id, "user": "test", "date": date or datetime.now(utc), "changesets": [], "changesetdata": dict() }
+    for (node, parents, files) in changesets:
+        push["changesets"].append(node)
+        push["changesetdata"][node] = { "node": node, "author": "Test <test>", "date": [1400000000, 0],
+                                        "desc": "Changeset %s" % node, "parents": parents, "files": files }
+    return push
+
+class PushlogTest(NestedIntervals, TransactionTestCase):
+    def setUp(self):
+        self.first = Repository(name = "first", url = "http://localhost/first/", range = 86400)
+        self.first.save()
+        self.second = Repository(name = "second", url = "http://localhost/second/", range = 86400)
+        self.second.save()
+
+    def updated(self, repository):
+        # The checkpoint left by an earlier update, after which the tree is
+        # current and added files are found without the diff
+        return Checkpoint.objects.create(repository = repository, push_id = 0)
+
+    def add_shared(self):
+        # The first repository has an old push of a changeset shared with the
+        # second and one of its own, then a recent push
+        ui = QuietUI()
+        shared = ("4" * 40, ["3" * 40], ["d/shared.txt"])
+        own = ("5" * 40, [shared[0]], ["x/own.txt"])
+        recent = ("6" * 40, [own[0]], ["d/recent.txt"])
+        old = datetime.now(utc) - timedelta(days = 2)
+        add_pushes(ui, self.first, [pushlog_push(1, [shared, own], old), pushlog_push(2, [recent])], self.updated(self.first))
+        add_pushes(ui, self.second, [pushlog_push(1, [shared])], self.updated(self.second))
+        return (shared[0], own[0], recent[0])
+
+    def test_expire_shared(self):
+        (shared, own, recent) = self.add_shared()
+        expire_changesets(QuietUI(), self.first)
+
+        self.assertEqual(set(Changeset.objects.values_list("hex", flat = True)), set([shared, recent]))
+        self.assertFalse(Change.objects.filter(changeset__hex = own).exists())
+        self.assertFalse(ChangesetParent.objects.filter(changeset__hex = own).exists())
+        self.assertTrue(Change.objects.filter(changeset__hex = shared).exists())
+        self.assertTrue(ChangesetParent.objects.filter(changeset__hex = shared).exists())
+        self.assertEqual(list(Push.objects.filter(repository = self.first).values_list("push_id", flat = True)), [2])
+        self.assertEqual(set(PathChangeset.objects.filter(repository = self.first).values_list("changeset__hex", flat = True)),
+                         set([recent]))
+        self.assertEqual(set(PathChangeset.objects.filter(repository = self.second).values_list("changeset__hex", flat = True)),
+                         set([shared]))
+
+    def test_deleterepo(self):
+        (shared, own, recent) = self.add_shared()
+        call_command("deleterepo", "first", verbosity = 0)
+
+        self.assertFalse(Repository.objects.filter(name = "first").exists())
+        self.assertEqual(list(Changeset.objects.values_list("hex", flat = True)), [shared])
+        self.assertEqual(set(Change.objects.values_list("changeset__hex", flat = True)), set([shared]))
+        self.assertEqual(set(ChangesetParent.objects.values_list("changeset__hex", flat = True)), set([shared]))
+        self.assertFalse(Checkpoint.objects.filter(repository__name = "first").exists())
+        self.assertEqual(set(PathChangeset.objects.values_list("repository_id", flat = True)), set([self.second.id]))
+        # Paths only the deleted repository had are gone
+        self.assertEqual(set(Path.objects.values_list("path", flat = True)), set(["", "d", "d/shared.txt"]))
+        self.assertEqual(set(self.second.paths.values_list("path", flat = True)), set(["", "d", "d/shared.txt"]))
+
+    def test_known_changeset_files(self):
+        # A file added by a changeset indexed for another repository is not new
+        # to this one once that changeset is pushed here too
+        ui = QuietUI()
+        added = ("1" * 40, [NULL_HEX], ["d/f.txt"])
+        modified = ("2" * 40, [added[0]], ["d/f.txt"])
+        add_pushes(ui, self.first, [pushlog_push(1, [added])], self.updated(self.first))
+        self.assertEqual(Change.objects.get(changeset__hex = added[0]).type, "A")
+
+        source = PatchSource([fake_patch(modified[0], modified[1], "Test <test>", 1400000000, "Modified", { "d/f.txt": "M" })])
+        add_pushes(ui, self.second, [pushlog_push(1, [added, modified])], self.updated(self.second), source)
+        self.assertEqual(Change.objects.get(changeset__hex = modified[0]).type, "M")
+        self.assertTrue(self.second.paths.filter(path = "d/f.txt").exists())
+
+    def test_first_update_removal(self):
+        # The tree initrepo loads is the tip's so a file removed before it is
+        # missing from it without being new
+        ui = QuietUI()
+        resolver = PathResolver(self.first)
+        resolver.get_path("d/keep.txt")
+        resolver.flush()
+
+        removed = ("7" * 40, [NULL_HEX], ["d/gone.txt"])
+        source = PatchSource([fake_patch(removed[0], removed[1], "Test <test>", 1400000000, "Removed", { "d/gone.txt": "R" })])
+        add_pushes(ui, self.first, [pushlog_push(1, [removed])], source = source)
+        self.assertEqual(list(Change.objects.filter(changeset__hex = removed[0]).values_list("path__path", "type")),
+                         [(u"d/gone.txt", u"R")])
+
+    def test_concurrent_writers(self):
+        # Both writers look up the same changeset and paths before either has
+        # written them, as processes updating sibling repositories can
+        writers = [IndexWriter(r, PathResolver(r), ["3" * 40]) for r in (self.first, self.second)]
+        for writer in writers:
+            writer.add_push(1, "test", datetime.now(utc))
+            writer.add_changeset("3" * 40, "Test <test>", datetime.now(utc), 0, "Shared", [NULL_HEX], { "d/e/f.txt": "A" })
+            writer.add_push_changeset(1, "3" * 40, 0)
+        for writer in writers:
+            with transaction.commit_on_success():
+                writer.flush()
+
+        changeset = Changeset.objects.get(hex = "3" * 40)
+        self.assertEqual(changeset.changes.count(), 1)
+        self.assertEqual(changeset.pushes.count(), 2)
+        self.assertEqual(Path.objects.filter(path__startswith = "d").count(), 3)
+        for repository in (self.first, self.second):
+            self.assertEqual(set(repository.paths.values_list("path", flat = True)), set(["", "d", "d/e", "d/e/f.txt"]))
+        self.assertNested()
+
@@ -23,19 +23,11 @@ def path(request, repository_name, path_name):
     path = Path.get_by_path(path_name)
     repository = get_object_or_404(Repository, name = repository_name, paths = path, hidden = False)
 
-    queryparams = {
-        "pushes__push__repository": repository,
-    }
-
-    if path.parent is not None:
-        queryparams["changes__path__ancestors__ancestor"] = path
-
+    types = None
     if "types" in request.GET:
         types = [TYPEMAP[t] for t in request.GET["types"].split(",")]
-        queryparams["changes__type__in"] = types
 
-    changesets = Changeset.objects.filter(**queryparams).distinct().order_by("-pushes__push__push_id", "-pushes__index")
-    changesets = list(changesets[:200])
+    changesets = recent_changesets(repository, path, types, 200)
     if len(changesets):
         tag = "path:%s/%s:%s:%s" % (repository_name, path_name, changesets[0].hex, changesets[-1].hex)
     else:
@@ -67,6 +59,6 @@ def render_changeset(request, repository, changeset):
     context = {
       "repository": repository,
       "changeset": changeset,
-      "changes": sorted(changeset.changes.all(), cmp=lambda x,y: cmp(x.path.path, y.path.path)),
+      "changes": changeset_changes([changeset])[changeset.id],
     }
     return render(request, "changeset.html", context)